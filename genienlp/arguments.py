@@ -110,6 +110,13 @@ def parse_argv(parser):
     parser.add_argument('--max_output_length', default=150, type=int, help='maximum output length for generation')
     parser.add_argument('--max_generative_vocab', default=50000, type=int,
                         help='max vocabulary for the generative softmax')
+    parser.add_argument('--decoder_shortlist', action='store_true',
+                        help='Save the tokens that appear in the answers of the training data with the model. During greedy decoding and sampling, '
+                             'TransformerSeq2Seq models then only compute the logits of those tokens and of the tokens in the input. '
+                             'Beam search and --num_outputs greater than 1 still use the whole vocabulary')
+    parser.add_argument('--draft_ngram_table', action='store_true',
+                        help='Save a table of the n-grams in the answers of the training data with the model. With --num_draft_tokens, '
+                             'TransformerSeq2Seq models then also draft tokens from this table when the input has nothing to copy')
     parser.add_argument('--subsample', default=20000000, type=int, help='subsample the datasets')
     parser.add_argument('--preserve_case', action='store_false', dest='lower',
                         help='whether to preserve casing for all text')
@@ -188,6 +195,8 @@ def parse_argv(parser):
                         help='whether to use existing cached splits or generate new ones')
     parser.add_argument('--cache_input_data', action='store_true',
                         help='Cache examples from input data for faster subsequent trainings')
+    parser.add_argument('--cache_numericalized_data', action='store_true',
+                        help='Cache the tokenized input data, keyed by its content and the tokenizer, for faster subsequent runs')
     parser.add_argument('--use_curriculum', action='store_true', help='Use curriculum learning')
     parser.add_argument('--aux_dataset', default='', type=str,
                         help='path to auxiliary dataset (ignored if curriculum is not used)')
@@ -45,15 +45,29 @@ logger = logging.getLogger(__name__)
 
 # Feature function builders
 # drop means after applying dropout, nodrop means before
+# Each featurizer has a `requires` attribute, the set of fields of ConfidenceFeatures it reads,
+# so that models only compute those (see `ConfidenceEstimator.required_features()`)
+
+def requires(f: Callable, *fields: str) -> Callable:
+    f.requires = frozenset(fields)
+    return f
+
+def requires_same_as(f: Callable, *featurizers: Callable) -> Callable:
+    """
+    Marks `f` as requiring what all of `featurizers` require. If one of them does not say, neither does `f`
+    """
+    if all(hasattr(g, 'requires') for g in featurizers):
+        f.requires = frozenset().union(*(g.requires for g in featurizers))
+    return f
 
 def max_of(f: Callable) -> Callable:
-    return lambda x: f(x).max().view(-1)
+    return requires_same_as(lambda x: f(x).max().view(-1), f)
 
 def min_of(f: Callable) -> Callable:
-    return lambda x: f(x).min().view(-1)
+    return requires_same_as(lambda x: f(x).min().view(-1), f)
 
 def neg_of(f: Callable) -> Callable:
-    return lambda x: -f(x)
+    return requires_same_as(lambda x: -f(x), f)
 
 def cv_drop_logit(i: int) -> Callable:
     def f(x):
@@ -61,42 +75,44 @@ def cv_drop_logit(i: int) -> Callable:
         a[a.isnan()] = 0
         a[a.isinf()] = 0
         return a
-    return f
+    return requires(f, 'drop_logits')
 
 def var_drop_logit(i: int) -> Callable:
-    return lambda x: torch.var(x[i].drop_logits, dim=0).view(-1)
+    return requires(lambda x: torch.var(x[i].drop_logits, dim=0).view(-1), 'drop_logits')
 
 def mean_drop_logit(i: int) -> Callable:
-    return lambda x: torch.mean(x[i].drop_logits, dim=0).view(-1)
+    return requires(lambda x: torch.mean(x[i].drop_logits, dim=0).view(-1), 'drop_logits')
 
 def nodrop_entropies(i: int) -> Callable:
-    return lambda x: x[i].nodrop_entropies
+    return requires(lambda x: x[i].nodrop_entropies, 'nodrop_entropies')
 
 def nodrop_logit(i: int) -> Callable:
-    return lambda x: x[i].nodrop_logits
+    return requires(lambda x: x[i].nodrop_logits, 'nodrop_logits')
 
 def prediction_length(i: int) -> Callable:
-    return lambda x: torch.tensor(len(x[i].nodrop_logits)).view(-1)
+    return requires(lambda x: torch.tensor(x[i].prediction_length).view(-1))
 
 def input_length(i: int) -> Callable:
-    return lambda x: torch.tensor(len(x[i].context)).view(-1)
+    return requires(lambda x: torch.tensor(len(x[i].context)).view(-1))
 
 def nodrop_avg_logprob(i: int):
-    return lambda x: torch.mean(x[i].nodrop_logits).view(-1)
+    return requires(lambda x: torch.mean(x[i].nodrop_logits).view(-1), 'nodrop_logits')
 
 def variance_of_beam_logits(x):
     a = torch.var(torch.tensor([torch.mean(x[i].nodrop_logits).item() for i in range(1, 5)])).view(-1)
     return a
+requires(variance_of_beam_logits, 'nodrop_logits')
 
 def variance_of_beam_probs(x):
     a = torch.var(torch.tensor([torch.mean(x[i].nodrop_probs).item() for i in range(1, 5)])).view(-1)
     return a
+requires(variance_of_beam_probs, 'nodrop_probs')
 
 def mean_drop_avg_logprob(i):
-    return lambda x: torch.mean(x[i].drop_logits).view(-1)
+    return requires(lambda x: torch.mean(x[i].drop_logits).view(-1), 'drop_logits')
 
 def var_drop_avg_logprob(i):
-    return lambda x: torch.var(torch.mean(x[i].drop_logits, dim=1)).view(-1)
+    return requires(lambda x: torch.var(torch.mean(x[i].drop_logits, dim=1)).view(-1), 'drop_logits')
 
 def cv_drop_avg_logprob(i):
     def f(x):
@@ -104,22 +120,22 @@ def cv_drop_avg_logprob(i):
         a[a.isnan()] = 0
         a[a.isinf()] = 0
         return a
-    return f
+    return requires(f, 'drop_logits')
 
 def nodrop_seq_prob(i):
-    return lambda x: torch.prod(x[i].nodrop_probs).view(-1)
+    return requires(lambda x: torch.prod(x[i].nodrop_probs).view(-1), 'nodrop_probs')
 
 def mean_drop_seq_prob(i):
-    return lambda x: torch.mean(torch.prod(x[i].drop_probs, dim=1)).view(-1)
+    return requires(lambda x: torch.mean(torch.prod(x[i].drop_probs, dim=1)).view(-1), 'drop_probs')
 
 def mean_drop_prob(i):
-    return lambda x: torch.mean(x[i].drop_probs, dim=0).view(-1)
+    return requires(lambda x: torch.mean(x[i].drop_probs, dim=0).view(-1), 'drop_probs')
 
 def var_drop_seq_prob(i):
-    return lambda x: torch.var(torch.prod(x[i].drop_probs, dim=1)).view(-1)
+    return requires(lambda x: torch.var(torch.prod(x[i].drop_probs, dim=1)).view(-1), 'drop_probs')
 
 def var_drop_prob(i):
-    return lambda x: torch.var(x[i].drop_probs, dim=0).view(-1)
+    return requires(lambda x: torch.var(x[i].drop_probs, dim=0).view(-1), 'drop_probs')
 
 def cv_drop_seq_prob(i):
     def f(x):
@@ -127,7 +143,7 @@ def cv_drop_seq_prob(i):
         a[a.isnan()] = 0
         a[a.isinf()] = 0
         return a
-    return f
+    return requires(f, 'drop_probs')
 
 def cev_drop_seq_prob(i):
     """
@@ -138,7 +154,7 @@ def cev_drop_seq_prob(i):
         a[a.isnan()] = 0
         a[a.isinf()] = 0
         return a
-    return f
+    return requires(f, 'drop_probs')
 
 def cev_drop_prob(i):
     """
@@ -149,7 +165,7 @@ def cev_drop_prob(i):
         a[a.isnan()] = 0
         a[a.isinf()] = 0
         return a
-    return f
+    return requires(f, 'drop_probs')
 
 
 def accuracy_at_pass_rate(labels, confidence_scores):
@@ -174,6 +190,7 @@ def oracle_score(confidence: ConfidenceFeatures):
     # This way, all correct exampels are ranked above all incorrect examples.
     oracle_confidence = label*(np.random.random()/2+0.5) + (1-label)*(np.random.random()/2)
     return oracle_confidence
+requires(oracle_score)
 
 def evaluate_raw(dev_confidences: Iterable[ConfidenceFeatures], featurizer: Callable):
     """
@@ -231,6 +248,19 @@ class ConfidenceEstimator():
     def evaluate(self, dev_features, dev_labels):
         raise NotImplementedError()
 
+    def _all_featurizers(self) -> List[Callable]:
+        raise NotImplementedError()
+
+    def required_features(self):
+        """
+        Returns the fields of ConfidenceFeatures that this estimator reads, to be passed to `confidence_features()` of the model,
+        or None if some featurizer does not declare them (e.g. in estimators saved before featurizers did), in which case all are needed
+        """
+        featurizers = self._all_featurizers()
+        if not all(hasattr(f, 'requires') for f in featurizers):
+            return None
+        return frozenset().union(*(f.requires for f in featurizers))
+
     def save(self, path: str):
         with open(path, 'wb') as f:
             dill.dump(self, f, protocol=4)
@@ -257,6 +287,9 @@ class RawConfidenceEstimator(ConfidenceEstimator):
         confidence_scores = self.convert_to_features(confidences)
         return confidence_scores
 
+    def _all_featurizers(self) -> List[Callable]:
+        return [self.featurizer]
+
     def convert_to_features(self, confidences: Iterable[ConfidenceFeatures], train: bool = False):
         features = [self.featurizer(c) for c in confidences]
         return features
@@ -289,6 +322,15 @@ class TreeConfidenceEstimator(ConfidenceEstimator):
         self.mc_dropout= mc_dropout
         self.mc_dropout_num = mc_dropout_num
 
+    def _all_featurizers(self) -> List[Callable]:
+        featurizers = []
+        for featurizer in self.featurizers:
+            if isinstance(featurizer, tuple):
+                featurizers += list(featurizer)
+            else:
+                featurizers.append(featurizer)
+        return featurizers
+
     @staticmethod
     def _extract_confidence_scores(model, dev_dataset):
         prediction_probs = model.predict(dev_dataset, ntree_limit=model.best_ntree_limit)
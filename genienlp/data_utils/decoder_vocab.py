@@ -27,31 +27,100 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import torch
+
+
 class DecoderVocabulary(object):
+    """
+    Maps the ids of the full vocabulary to the ids of the decoder (limited) vocabulary and back.
+    Words that are not in the decoder vocabulary get a new limited id the first time they are encoded, so that they can be copied.
+    Both directions are stored as tensors, so a whole batch is mapped with one indexing operation.
+    """
+
     def __init__(self, words, full_vocab, pad_token, eos_token):
         self.full_vocab = full_vocab
         self.pad_token = pad_token
         self.eos_token = eos_token
         stoi = {word: idx for idx, (word, full_idx) in enumerate(words)}
-        self.limited_to_full = {stoi[word]: full_idx for word, full_idx in words}
-        self.full_to_limited = {full_idx: stoi[word] for word, full_idx in words}
+        limited_to_full = {stoi[word]: full_idx for word, full_idx in words}
         self.pad_idx = stoi[pad_token]
         self.eos_idx = stoi[eos_token]
 
+        self._size = len(limited_to_full)
+        # limited id -> full id; only the first len(self) entries are used, the rest is room to grow
+        self._limited_to_full = torch.zeros(max(limited_to_full.keys()) + 1, dtype=torch.long)
+        # full id -> limited id, or -1 if the full id has no limited id yet
+        self._full_to_limited = torch.full((max(len(full_vocab), max(limited_to_full.values()) + 1),), -1, dtype=torch.long)
+        for limited_idx, full_idx in limited_to_full.items():
+            self._limited_to_full[limited_idx] = full_idx
+            self._full_to_limited[full_idx] = limited_idx
+
+        # copies of the used part of _limited_to_full on the devices `decode_tensor()` was called with
+        # they are dropped whenever new words are added
+        self._device_limited_to_full = dict()
+
     def __len__(self):
-        return len(self.limited_to_full)
+        return self._size
+
+    @staticmethod
+    def _grow(t, min_size, fill_value):
+        if len(t) >= min_size:
+            return t
+        new_t = t.new_full((max(min_size, 2 * len(t)),), fill_value)
+        new_t[:len(t)] = t
+        return new_t
+
+    def _add(self, full_idx):
+        limited_idx = len(self)
+        self._limited_to_full = self._grow(self._limited_to_full, limited_idx + 1, 0)
+        self._limited_to_full[limited_idx] = full_idx
+        self._full_to_limited[full_idx] = limited_idx
+        self._size += 1
 
     def encode(self, full_idx_list):
-        limited_list = []
-        for full_idx in full_idx_list:
-            if full_idx in self.full_to_limited:
-                lim_idx = self.full_to_limited[full_idx]
-            else:
-                lim_idx = len(self)
-                self.limited_to_full[lim_idx] = full_idx
-                self.full_to_limited[full_idx] = lim_idx
-            limited_list.append(lim_idx)
-        return limited_list
+        if len(full_idx_list) == 0:
+            return []
+        full_ids = torch.tensor(full_idx_list, dtype=torch.long)
+        self._full_to_limited = self._grow(self._full_to_limited, full_ids.max().item() + 1, -1)
+        limited_ids = self._full_to_limited[full_ids]
+        missing = limited_ids < 0
+        if missing.any():
+            # new words get limited ids in the order they appear
+            for full_idx in full_ids[missing].tolist():
+                if self._full_to_limited[full_idx] < 0:
+                    self._add(full_idx)
+            self._device_limited_to_full.clear()
+            limited_ids = self._full_to_limited[full_ids]
+        return limited_ids.tolist()
+
+    def full_ids(self):
+        """
+        Returns the full id of every limited id, including the words added by `encode()`
+        """
+        return self._limited_to_full[:len(self)].tolist()
+
+    def restore(self, full_ids):
+        """
+        Adds the words that `encode()` added after this vocabulary was in its current state, given the `full_ids()`
+        of the vocabulary after those calls
+        """
+        if full_ids[:len(self)] != self.full_ids():
+            raise ValueError('The decoder vocabulary does not extend the current one')
+        self._full_to_limited = self._grow(self._full_to_limited, max(full_ids, default=0) + 1, -1)
+        for full_idx in full_ids[len(self):]:
+            self._add(full_idx)
+        self._device_limited_to_full.clear()
 
     def decode(self, lim_idx):
-        return self.limited_to_full[lim_idx]
+        if not 0 <= lim_idx < len(self):
+            raise KeyError(lim_idx)
+        return self._limited_to_full[lim_idx].item()
+
+    def decode_tensor(self, limited_ids):
+        """
+        Maps a tensor of limited ids to full ids, on the device of `limited_ids`
+        """
+        device = limited_ids.device
+        if device not in self._device_limited_to_full:
+            self._device_limited_to_full[device] = self._limited_to_full[:len(self)].to(device)
+        return self._device_limited_to_full[device][limited_ids]
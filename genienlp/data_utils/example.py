@@ -27,10 +27,17 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import os
+import shutil
+import hashlib
+import logging
 import unicodedata
 from typing import NamedTuple, List, Union, Iterable
+import numpy as np
 import torch
 
+logger = logging.getLogger(__name__)
+
 
 def identity(x, **kw):
     return x
@@ -123,4 +130,174 @@ class NumericalizedExamples(NamedTuple):
 
         return NumericalizedExamples(example_id=example_id,
                                      context=context,
-                                     answer=answer)
\ No newline at end of file
+                                     answer=answer)
+
+
+class NumericalizedField(object):
+    """
+    One SequentialField of all the examples of a dataset, stored as flat arrays instead of a list of Python ints per example.
+    Example i is `values[offsets[i]:offsets[i]+lengths[i]]`; `limiteds` is indexed the same way, and is empty if there is
+    no decoder vocabulary
+    """
+
+    def __init__(self, values: np.ndarray, limiteds: np.ndarray, offsets: np.ndarray, lengths: np.ndarray):
+        self.values = values
+        self.limiteds = limiteds
+        self.offsets = offsets
+        self.lengths = lengths
+
+    @staticmethod
+    def from_sequential_fields(fields: List[SequentialField]):
+        lengths = np.array([len(f.value) for f in fields], dtype=np.int64)
+        offsets = np.zeros(len(fields), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        values = np.fromiter((token for f in fields for token in f.value), dtype=np.int32, count=int(lengths.sum()))
+        if any(len(f.limited) > 0 for f in fields):
+            limiteds = np.fromiter((token for f in fields for token in f.limited), dtype=np.int32, count=int(lengths.sum()))
+        else:
+            limiteds = np.zeros(0, dtype=np.int32)
+        return NumericalizedField(values, limiteds, offsets, lengths)
+
+    @staticmethod
+    def concatenate(fields: List['NumericalizedField']):
+        """
+        Concatenates fields created by `from_sequential_fields()` (i.e. whose examples are stored contiguously and in order)
+        """
+        lengths = np.concatenate([f.lengths for f in fields])
+        offsets = np.zeros(len(lengths), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        return NumericalizedField(np.concatenate([f.values for f in fields]), np.concatenate([f.limiteds for f in fields]), offsets, lengths)
+
+    def save(self, dirname, name):
+        for array in ('values', 'limiteds', 'offsets', 'lengths'):
+            np.save(os.path.join(dirname, f'{name}.{array}.npy'), getattr(self, array))
+
+    @staticmethod
+    def load(dirname, name):
+        # token ids are memory-mapped, so that processes reading the same cache share pages and nothing is read
+        # until it is used; offsets and lengths are always indexed as a whole, so they are read into memory
+        return NumericalizedField(np.load(os.path.join(dirname, f'{name}.values.npy'), mmap_mode='r'),
+                                  np.load(os.path.join(dirname, f'{name}.limiteds.npy'), mmap_mode='r'),
+                                  np.load(os.path.join(dirname, f'{name}.offsets.npy')),
+                                  np.load(os.path.join(dirname, f'{name}.lengths.npy')))
+
+    def select(self, indices):
+        return NumericalizedField(self.values, self.limiteds, self.offsets[indices], self.lengths[indices])
+
+    def __getitem__(self, i):
+        start, length = self.offsets[i], self.lengths[i]
+        limited = self.limiteds[start:start+length] if len(self.limiteds) > 0 else []
+        return SequentialField(value=self.values[start:start+length], length=int(length), limited=limited)
+
+    def _pad(self, flat, indices, pad_id):
+        offsets, lengths = self.offsets[indices], self.lengths[indices]
+        positions = np.arange(lengths.max())
+        mask = positions[None, :] < lengths[:, None]
+        gather = np.where(mask, offsets[:, None] + positions[None, :], 0)
+        return np.where(mask, flat[gather], pad_id).astype(np.int64)
+
+    def collate(self, indices, pad_id, decoder_pad_id, device):
+        """
+        Returns a SequentialField of padded tensors for the examples at `indices`, like `NumericalizedExamples.collate_batches()`
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        value = torch.from_numpy(self._pad(self.values, indices, pad_id)).to(device)
+        if len(self.limiteds) > 0:
+            limited = torch.from_numpy(self._pad(self.limiteds, indices, decoder_pad_id)).to(device)
+        else:
+            limited = torch.zeros((len(indices), 0), dtype=torch.long, device=device)
+        length = torch.from_numpy(self.lengths[indices]).to(device)
+        return SequentialField(value=value, length=length, limited=limited)
+
+
+class NumericalizedDataset(object):
+    """
+    The numericalized examples of a whole dataset, stored column by column.
+    Indexing returns a NumericalizedExamples for a single example (like the elements returned by `NumericalizedExamples.from_examples()`),
+    which is what sort and batch size functions expect, but batches are collated directly from the columns with `collate()`.
+    """
+
+    # number of examples tokenized at once, so that only that many examples are ever held as Python lists
+    CHUNK_SIZE = 100000
+
+    def __init__(self, example_id: List[str], context: NumericalizedField, answer: NumericalizedField):
+        self.example_id = example_id
+        self.context = context
+        self.answer = answer
+
+    @staticmethod
+    def from_examples(examples, numericalizer):
+        assert all(isinstance(ex.example_id, str) for ex in examples)
+        example_ids, contexts, answers = [], [], []
+        for start in range(0, len(examples), NumericalizedDataset.CHUNK_SIZE):
+            chunk = examples[start:start+NumericalizedDataset.CHUNK_SIZE]
+            example_ids += [ex.example_id for ex in chunk]
+            contexts.append(NumericalizedField.from_sequential_fields(numericalizer.encode_batch([ex.context_plus_question for ex in chunk])))
+            answers.append(NumericalizedField.from_sequential_fields(numericalizer.encode_batch([ex.answer for ex in chunk])))
+        if len(contexts) == 1:
+            return NumericalizedDataset(example_ids, contexts[0], answers[0])
+        return NumericalizedDataset(example_ids, NumericalizedField.concatenate(contexts), NumericalizedField.concatenate(answers))
+
+    @staticmethod
+    def cache_key(examples, numericalizer):
+        """
+        A hash of the inputs of `from_examples()`: the text that is tokenized and the numericalizer.
+        The text is hashed after preprocessing, so options that change it (such as lowercasing or detokenization)
+        produce a different key.
+        """
+        hasher = hashlib.sha256(numericalizer.fingerprint().encode('ascii'))
+        for start in range(0, len(examples), NumericalizedDataset.CHUNK_SIZE):
+            chunk = examples[start:start+NumericalizedDataset.CHUNK_SIZE]
+            hasher.update(''.join(ex.context_plus_question + '\0' + ex.answer + '\0' for ex in chunk).encode('utf-8'))
+        return hasher.hexdigest()
+
+    @staticmethod
+    def from_examples_cached(examples, numericalizer, cache_dir):
+        """
+        Like `from_examples()`, but reuses the result of a previous call on the same examples with the same numericalizer,
+        stored in `cache_dir`.
+        Encoding adds the new words of the examples to the decoder vocabulary, if there is one, so the cache also stores
+        the decoder vocabulary after encoding, and restores it when the cache is used.
+        """
+        cache_name = os.path.join(cache_dir, NumericalizedDataset.cache_key(examples, numericalizer))
+        if os.path.exists(cache_name):
+            logger.info(f'Loading numericalized data from {cache_name}')
+            if numericalizer.decoder_vocab is not None:
+                numericalizer.decoder_vocab.restore(np.load(os.path.join(cache_name, 'decoder_vocab.npy')).tolist())
+            return NumericalizedDataset([ex.example_id for ex in examples],
+                                        NumericalizedField.load(cache_name, 'context'),
+                                        NumericalizedField.load(cache_name, 'answer'))
+
+        dataset = NumericalizedDataset.from_examples(examples, numericalizer)
+        logger.info(f'Caching numericalized data to {cache_name}')
+        # write to a temporary directory and rename it, so other processes never see a partial cache
+        tmp_name = f'{cache_name}.tmp{os.getpid()}'
+        os.makedirs(tmp_name, exist_ok=True)
+        dataset.context.save(tmp_name, 'context')
+        dataset.answer.save(tmp_name, 'answer')
+        if numericalizer.decoder_vocab is not None:
+            np.save(os.path.join(tmp_name, 'decoder_vocab.npy'), np.array(numericalizer.decoder_vocab.full_ids(), dtype=np.int64))
+        try:
+            os.rename(tmp_name, cache_name)
+        except OSError:
+            # another process created the same cache in the meantime
+            shutil.rmtree(tmp_name)
+        return dataset
+
+    def __len__(self):
+        return len(self.example_id)
+
+    def __getitem__(self, i):
+        return NumericalizedExamples([self.example_id[i]], self.context[i], self.answer[i])
+
+    def select(self, indices):
+        """
+        Returns the examples at `indices`, in that order. The token arrays are shared, not copied
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        return NumericalizedDataset([self.example_id[i] for i in indices], self.context.select(indices), self.answer.select(indices))
+
+    def collate(self, indices, numericalizer, device):
+        return NumericalizedExamples(example_id=[self.example_id[i] for i in indices],
+                                     context=self.context.collate(indices, numericalizer.pad_id, numericalizer.decoder_pad_id, device),
+                                     answer=self.answer.collate(indices, numericalizer.pad_id, numericalizer.decoder_pad_id, device))
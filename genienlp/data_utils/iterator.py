@@ -31,6 +31,7 @@
 import torch
 import random
 import logging
+import numpy as np
 
 
 logger = logging.getLogger(__name__)
@@ -41,12 +42,14 @@ class LengthSortedIterator(torch.utils.data.Sampler):
     """
     """
 
-    def __init__(self, data_source, batch_size, sort, shuffle_and_repeat, sort_key_fn, batch_size_fn, groups=1):
+    def __init__(self, data_source, batch_size, sort, shuffle_and_repeat, sort_key_fn, batch_size_fn, groups=1,
+                 keep_large_examples=False):
         """
         batch_size: can be number of tokens or number of examples, the type is inferred from batch_size_fn
         sort: if False, disables sorting and uses the original order. Useful for evaluation.
         shuffle_and_repeat: if True, the order of returned examples are semi-shuffled, and there is no end to the iterator
         groups: used for sentence batching
+        keep_large_examples: if True, each example larger than batch_size gets a batch of its own instead of being skipped
         """
         if groups is None:
             groups = 1
@@ -56,84 +59,204 @@ class LengthSortedIterator(torch.utils.data.Sampler):
         self.sort_key = sort_key_fn
         self.batch_size_fn = batch_size_fn
         self.groups = groups
-        
+
+        # call the key and size functions once per example, everything else works on arrays
+        sort_keys = []
+        sizes = []
+        for i in range(len(data_source)):
+            example = data_source[i]
+            if sort:
+                sort_keys.append(self.sort_key(example))
+            sizes.append(self.batch_size_fn(example))
+        sizes = np.array(sizes, dtype=np.int64)
+
         if sort:
-            # sort while keeping track of the original order
-            data_with_original_order = list(zip(data_source, range(len(data_source)))) # list of tuples of the form (data_source[i], i)
-            # sort based on data_source 
-            sorted_data_with_original_order = sorted(data_with_original_order, key=lambda x: self.sort_key(x[0]), reverse=True) # sort from long to short
-            # separate the two parts of each tuple
-            self.data_source, self.original_order = tuple(zip(*sorted_data_with_original_order))
+            # sort from long to short while keeping track of the original order
+            self.original_order = self._sort_descending(sort_keys)
+            if hasattr(data_source, 'select'):
+                # columnar datasets (NumericalizedDataset) reorder their index arrays instead of copying the examples
+                self.data_source = data_source.select(self.original_order)
+            else:
+                self.data_source = tuple(data_source[i] for i in self.original_order)
+            sizes = sizes[self.original_order]
         else:
             self.data_source, self.original_order = data_source, list(range(len(data_source)))
+        self.sizes = sizes
         self.batch_size = batch_size # number of examples or number of tokens
         self.shuffle_and_repeat = shuffle_and_repeat
-        self.last_batch_start_index = 0
-        self.last_batch_start_index = self._get_next_batch_start_index()
-        
+        self.keep_large_examples = keep_large_examples
+        self._compute_batch_ends(sizes)
+
         if not self.shuffle_and_repeat:
-            # quickly iterate over self to calculate length
-            self.length = 0
-            for _ in self:
-                self.length += 1
-            # reset state
-            self.last_batch_start_index = 0
-            self.last_batch_start_index = self._get_next_batch_start_index()
+            self.batch_starts = self._sequential_batch_starts()
+            self.length = len(self.batch_starts)
         else:
             self.length = len(self.data_source)
-            
+        self.last_batch_index = 0
+
+    @staticmethod
+    def _sort_descending(sort_keys):
+        """
+        Returns the indices that sort `sort_keys` in descending order, keeping the original order of equal keys
+        """
+        keys = np.array(sort_keys) if len(sort_keys) > 0 else np.zeros(0, dtype=np.int64)
+        if keys.dtype.kind in 'iu' and keys.ndim == 1:
+            return np.argsort(-keys.astype(np.int64), kind='stable').tolist()
+        if keys.dtype.kind in 'iu' and keys.ndim == 2:
+            # tuple keys: np.lexsort sorts by the last column first
+            return np.lexsort(tuple(-keys[:, j].astype(np.int64) for j in reversed(range(keys.shape[1])))).tolist()
+        # other keys (e.g. strings) are compared by Python
+        return sorted(range(len(sort_keys)), key=sort_keys.__getitem__, reverse=True)
+
+    def _compute_batch_ends(self, sizes):
+        """
+        Computes, for every position, where a batch starting there begins and ends.
+
+        Examples are sorted from long to short, so the first example of a batch is the longest, and every example in the batch
+        is counted with its size (i.e. including padding). Hence the length of a batch only depends on where it starts.
+        Examples larger than the batch size are skipped, so a batch starting at one of them starts at the next example instead,
+        unless `keep_large_examples` is set.
+        """
+        n = len(sizes)
+        too_large = sizes > self.batch_size
+        if self.keep_large_examples:
+            too_large[:] = False
+        elif too_large.any():
+            global _warned_for_batch_size
+            if not _warned_for_batch_size:
+                logger.warning('Skipping an example larger than batch size. Consider increasing the batch size to avoid this warning')
+                _warned_for_batch_size = True
+
+        # first position at or after each position that holds an example that is not too large (n if there is none)
+        positions = np.where(too_large, n, np.arange(n))
+        self.valid_starts = np.minimum.accumulate(positions[::-1])[::-1] if n > 0 else positions
+
+        # number of examples that fit in a batch, if the batch starts at each position; at least the first one
+        capacity = np.where(sizes > 0, np.maximum(self.batch_size // np.maximum(sizes, 1), 1), n)
+        # don't wrap around to position 0; there is a large difference between the length of the first and last element
+        self.batch_ends = np.minimum(np.arange(n) + capacity, n)
+
+    def _sequential_batch_starts(self):
+        starts = []
+        n = len(self.data_source)
+        i = 0
+        while i < n:
+            i = int(self.valid_starts[i])
+            if i == n:
+                break
+            starts.append(i)
+            i = int(self.batch_ends[i])
+        return starts
 
     def __len__(self):
         return self.length
 
     def __iter__(self):
-        self.last_batch_start_index = 0
-        self.last_batch_start_index = self._get_next_batch_start_index()
+        self.last_batch_index = 0
         return self
 
     def __next__(self):
-        batch_of_indices = []
-        current_batch_size = 0
-        i = self._get_next_batch_start_index()
-        if i >= len(self.data_source):
-            # This is the end of the iterator
-            assert not self.shuffle_and_repeat
-            raise StopIteration
-        while current_batch_size < self.batch_size:
-            new_example = self.data_source[i]
-            if len(batch_of_indices) > 0:
-                longest_example = self.data_source[batch_of_indices[0]] # we sorted in descending order of length, so the first one is the longest
-            else:
-                longest_example = new_example # this is the first element in batch, and therefore the longest
-            examples_size = self.batch_size_fn(longest_example)
-            if examples_size > self.batch_size:
-                global _warned_for_batch_size
-                if not _warned_for_batch_size:
-                    logger.warning('Skipping an example larger than batch size. Consider increasing the batch size to avoid this warning')
-                    _warned_for_batch_size = True
-                self.last_batch_start_index += 1
-                i += 1
-                continue
-                
-            new_batch_size = current_batch_size + self.batch_size_fn(longest_example)
-            if new_batch_size > self.batch_size:
-                # the new example would put us over the batch size limit
-                break
+        if self.shuffle_and_repeat:
+            if self.valid_starts[0] == len(self.data_source):
+                raise ValueError('All examples are larger than the batch size')
+            start = len(self.data_source)
+            while start == len(self.data_source):
+                # if self.groups > 1, this ensures that the start of each batch is a multiply of self.groups, i.e. where a group starts
+                start = int(self.valid_starts[random.randrange(0, len(self.data_source) // self.groups) * self.groups])
+        else:
+            if self.last_batch_index >= len(self.batch_starts):
+                # This is the end of the iterator
+                raise StopIteration
+            start = self.batch_starts[self.last_batch_index]
+            self.last_batch_index += 1
 
-            batch_of_indices.append(i)
-            current_batch_size = new_batch_size
-            i += 1
+        return list(range(start, int(self.batch_ends[start])))
 
-            if i == len(self.data_source):
-                break # don't start from i=0; there is a large difference between the length of the first and last element
 
-        self.last_batch_start_index += len(batch_of_indices)
-        return batch_of_indices
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Samples batches of examples of similar length, going through all examples once per epoch, with no end.
 
-    def _get_next_batch_start_index(self):
-        if self.shuffle_and_repeat:
-            # if self.groups > 1, this ensures that the start of each batch is a multiply of self.groups, i.e. where a group starts
-            return random.randrange(0, len(self.data_source) / self.groups) * self.groups
-        else:
-            return self.last_batch_start_index
-   
\ No newline at end of file
+    Examples are sorted by length and split into buckets of consecutive examples, each as large as `batches_per_bucket`
+    length-sorted batches. Every epoch, the examples of each bucket are shuffled and grouped into batches, and then the
+    batches of all buckets are shuffled together.
+    The batches of an epoch only depend on the seed and the epoch number, so the position in the stream of batches is
+    completely described by `state_dict()`, and can be restored with `load_state_dict()` without going through the batches.
+    """
+
+    def __init__(self, data_source, batch_size, sort_key_fn, batch_size_fn, batches_per_bucket=100, seed=None):
+        """
+        batch_size: can be number of tokens or number of examples, the type is inferred from batch_size_fn
+        seed: seed of the shuffling; if None, it is drawn from the `random` module
+        """
+        layout = LengthSortedIterator(data_source, batch_size, sort=True, shuffle_and_repeat=False,
+                                      sort_key_fn=sort_key_fn, batch_size_fn=batch_size_fn)
+        self.data_source = layout.data_source
+        self.original_order = layout.original_order
+        self.batch_size = batch_size
+        self.length = len(layout)
+        self._sizes = layout.sizes.tolist()
+
+        # buckets are (start, end) ranges of positions in the sorted data source
+        bucket_starts = layout.batch_starts[::batches_per_bucket]
+        self._buckets = list(zip(bucket_starts, bucket_starts[1:] + [len(self.data_source)]))
+
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.epoch = 0
+        # index of the next batch in the current epoch
+        self.cursor = 0
+        self._batches = None
+        self._batches_epoch = None
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'seed': self.seed, 'cursor': self.cursor}
+
+    def load_state_dict(self, state_dict):
+        self.epoch = state_dict['epoch']
+        self.seed = state_dict['seed']
+        self.cursor = state_dict['cursor']
+
+    def _epoch_batches(self, epoch):
+        rng = np.random.RandomState((self.seed + epoch) % 2 ** 32)
+        batches = []
+        for start, end in self._buckets:
+            batch = []
+            longest = 0
+            for i in (start + rng.permutation(end - start)).tolist():
+                size = self._sizes[i]
+                if size > self.batch_size:
+                    # LengthSortedIterator already warned about these
+                    continue
+                # every example in the batch is counted with the size of the longest one, because of padding
+                longest_with_i = max(longest, size)
+                if len(batch) > 0 and longest_with_i * (len(batch) + 1) > self.batch_size:
+                    batches.append(batch)
+                    batch = []
+                    longest_with_i = size
+                batch.append(i)
+                longest = longest_with_i
+            if len(batch) > 0:
+                batches.append(batch)
+
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def __len__(self):
+        # approximately the number of batches in one epoch
+        return self.length
+
+    def __iter__(self):
+        # iterating continues from the current state, so that a restored sampler picks up where the saved one stopped
+        while True:
+            if self._batches_epoch != self.epoch:
+                self._batches = self._epoch_batches(self.epoch)
+                self._batches_epoch = self.epoch
+                if len(self._batches) == 0:
+                    raise ValueError('All examples are larger than the batch size')
+            if self.cursor >= len(self._batches):
+                self.epoch += 1
+                self.cursor = 0
+                continue
+
+            batch = self._batches[self.cursor]
+            self.cursor += 1
+            yield batch
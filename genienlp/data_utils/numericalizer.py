@@ -30,6 +30,7 @@
 import os
 import re
 import json
+import hashlib
 import multiprocessing
 from typing import List, Tuple
 from collections import defaultdict, Counter
@@ -53,6 +54,9 @@ ALLOWED_FAST_TOKENIZERS = {
 # mBART, t5, and mt5 models work when preprocessing, because they're SPM/RoBERTa-based so they respect
 # whitespace, but the fast tokenizers treat special tokens differently than the slow ones
 # and drop whitespace before special tokens, which breaks
+# longest n-gram of the answer n-gram table
+MAX_ANSWER_NGRAM = 3
+
 ALLOWED_FAST_TOKENIZERS_IF_PREPROCESSING = {
     'facebook/mbart-large-cc25',
     'sshleifer/tiny-mbart',
@@ -73,13 +77,21 @@ class TransformerNumericalizer(object):
     _special_tokens_to_token_regexes : List[Tuple[re.Pattern, str]]
 
     def __init__(self, pretrained_tokenizer, max_generative_vocab, cache=None,
-                 preprocess_special_tokens=False):
+                 preprocess_special_tokens=False, build_output_shortlist=False, build_answer_ngrams=False):
         self._pretrained_name = pretrained_tokenizer
         self.max_generative_vocab = max_generative_vocab
         self._cache = cache
         self._tokenizer = None
 
         self._preprocess_special_tokens = preprocess_special_tokens
+        self._build_output_shortlist = build_output_shortlist
+        self._build_answer_ngrams = build_answer_ngrams
+
+        # sorted ids of the tokens that appear in the answers of the training data, plus the special tokens
+        self.output_shortlist = None
+        # maps n-grams of the answers in the training data (tuples of up to MAX_ANSWER_NGRAM token ids) to the token that
+        # follows them most often
+        self.answer_ngrams = None
 
         # map a token to a space-separated sequence of words
         self._special_tokens_to_word_map = []
@@ -88,6 +100,12 @@ class TransformerNumericalizer(object):
         # map a space-separated sequence of words to a token
         self._special_tokens_to_token_regexes = []
 
+        # special tokens that grow_vocab already added to the tokenizer
+        self._grown_special_tokens = set()
+        # number of special tokens of each task the last time grow_vocab looked at it
+        # tasks only ever add special tokens, so if the number did not change there is nothing new
+        self._grown_task_sizes = dict()
+
     @property
     def vocab(self):
         return self._tokenizer
@@ -126,6 +144,18 @@ class TransformerNumericalizer(object):
             self._build_special_tokens_regexes()
         except FileNotFoundError:
             pass
+        try:
+            with open(os.path.join(save_dir, 'output-shortlist.txt')) as fp:
+                shortlist = set(self._tokenizer.convert_tokens_to_ids(line.rstrip('\n')) for line in fp)
+            self.output_shortlist = sorted(shortlist | set(self._tokenizer.all_special_ids))
+        except FileNotFoundError:
+            pass
+        try:
+            with open(os.path.join(save_dir, 'answer-ngrams.json')) as fp:
+                self.answer_ngrams = {tuple(self._tokenizer.convert_tokens_to_ids(ngram)): self._tokenizer.convert_tokens_to_ids(token)
+                                      for ngram, token in json.load(fp)}
+        except FileNotFoundError:
+            pass
 
         self._init()
 
@@ -145,6 +175,42 @@ class TransformerNumericalizer(object):
         if len(self._special_tokens_to_word_map) > 0:
             with open(os.path.join(save_dir, 'special-token-preprocessing.json'), 'w') as fp:
                 json.dump(self._special_tokens_to_word_map, fp)
+        if self.output_shortlist is not None:
+            with open(os.path.join(save_dir, 'output-shortlist.txt'), 'w') as fp:
+                for token in self._tokenizer.convert_ids_to_tokens(self.output_shortlist):
+                    fp.write(token + '\n')
+        if self.answer_ngrams is not None:
+            with open(os.path.join(save_dir, 'answer-ngrams.json'), 'w') as fp:
+                json.dump([(self._tokenizer.convert_ids_to_tokens(list(ngram)), self._tokenizer.convert_ids_to_tokens(token))
+                           for ngram, token in self.answer_ngrams.items()], fp)
+
+    def fingerprint(self):
+        """
+        Returns a hash of everything that affects how sentences are numericalized: the tokenizer files, the tokens added to
+        the tokenizer, the special token preprocessing and the decoder vocabulary.
+        The decoder vocabulary grows as sentences are encoded, so the hash includes the words it has now, not just the
+        initial ones.
+        """
+        hasher = hashlib.sha256()
+        hasher.update(type(self._tokenizer).__name__.encode('utf-8'))
+        found_files = False
+        for file_id in sorted(self._tokenizer.vocab_files_names):
+            path = self._tokenizer.init_kwargs.get(file_id)
+            if isinstance(path, str) and os.path.isfile(path):
+                found_files = True
+                with open(path, 'rb') as fp:
+                    for block in iter(lambda: fp.read(1 << 20), b''):
+                        hasher.update(block)
+        if not found_files:
+            hasher.update(json.dumps(sorted(self._tokenizer.get_vocab().items())).encode('utf-8'))
+
+        decoder_words = self.decoder_vocab.full_ids() if self.decoder_vocab is not None else None
+        hasher.update(json.dumps([sorted(self._tokenizer.get_added_vocab().items()),
+                                  self._tokenizer.special_tokens_map,
+                                  self._preprocess_special_tokens,
+                                  self._special_tokens_to_word_map,
+                                  decoder_words], sort_keys=True).encode('utf-8'))
+        return hasher.hexdigest()
 
     def build_vocab(self, vocab_sets, tasks):
         self._tokenizer = AutoTokenizer.from_pretrained(self._pretrained_name,
@@ -196,6 +262,27 @@ class TransformerNumericalizer(object):
                                   [(word, self._tokenizer.convert_tokens_to_ids(word)) for word, _freq
                                    in decoder_words.most_common(self.max_generative_vocab)]
 
+        if self._build_output_shortlist or self._build_answer_ngrams:
+            # only token ids are needed, so this does not go through encode_batch(), which also needs the decoder vocabulary
+            answers = [numerical for dataset in vocab_sets for numerical in self._encode_token_ids([example.answer for example in dataset])[0]]
+
+            if self._build_output_shortlist:
+                # the tokens the decoder has to generate for the answers in the dataset
+                # at inference time, only these and the tokens of the input need to be scored
+                shortlist = set(self._tokenizer.all_special_ids)
+                for numerical in answers:
+                    shortlist.update(numerical)
+                self.output_shortlist = sorted(shortlist)
+
+            if self._build_answer_ngrams:
+                # used to draft the next tokens during speculative greedy decoding
+                next_token_counts = defaultdict(Counter)
+                for numerical in answers:
+                    for end in range(1, len(numerical)):
+                        for n in range(1, min(MAX_ANSWER_NGRAM, end) + 1):
+                            next_token_counts[tuple(numerical[end-n:end])][numerical[end]] += 1
+                self.answer_ngrams = {ngram: counts.most_common(1)[0][0] for ngram, counts in next_token_counts.items()}
+
         self._init()
 
     def grow_vocab(self, tasks):
@@ -207,7 +294,15 @@ class TransformerNumericalizer(object):
 
         # add the new special tokens from the task
         for task in tasks:
-            self._tokenizer.add_tokens(list(task.special_tokens))
+            if self._grown_task_sizes.get(task) == len(task.special_tokens):
+                continue
+            new_tokens = [token for token in task.special_tokens if token not in self._grown_special_tokens]
+            self._grown_task_sizes[task] = len(task.special_tokens)
+            if new_tokens:
+                self._tokenizer.add_tokens(new_tokens)
+                self._grown_special_tokens.update(new_tokens)
+                if self.output_shortlist is not None:
+                    self.output_shortlist = sorted(set(self.output_shortlist) | set(self._tokenizer.convert_tokens_to_ids(new_tokens)))
 
     def _build_special_tokens_maps(self, special_tokens):
         # we automatically construct the mapping from special tokens to the shortest unambiguous
@@ -322,13 +417,9 @@ class TransformerNumericalizer(object):
             self.generative_vocab_size = len(self._tokenizer)
             self.decoder_vocab = None
 
-    def encode_batch(self, sentences: List[str], multiprocessing_threshold=5000) -> List[SequentialField]:
+    def _encode_token_ids(self, sentences: List[str], multiprocessing_threshold=5000) -> Tuple[List[List[int]], List[int]]:
         """
-        Batched version of `encode_single()`. Uses multiprocessing on all CPU cores for preprocessing,
-        and multithreading for tokenization if a `FastTokenizer` is used
-        Inputs:
-            sentences: a list of sentences to encode
-            multiprocessing_threshold: for input batches smaller than this value, multiprocessing will not be used due to its overhead
+        Preprocesses and tokenizes `sentences`, returning the token ids and the length of each sentence
         """
         # We need to set this so that `tokenizers` package does not complain about detecting forks.
         os.environ['TOKENIZERS_PARALLELISM'] = "true"
@@ -341,13 +432,26 @@ class TransformerNumericalizer(object):
                 sentences = list(map(self._apply_special_token_preprocessing, sentences))
         batch_encoded = self._tokenizer.batch_encode_plus(sentences, add_special_tokens=True, max_length=None,
                                               return_length=True, padding=False, return_attention_mask=False)
-        batch_numerical = batch_encoded.data['input_ids']
-        batch_length = batch_encoded.data['length']
+        return batch_encoded.data['input_ids'], batch_encoded.data['length']
+
+    def encode_batch(self, sentences: List[str], multiprocessing_threshold=5000) -> List[SequentialField]:
+        """
+        Batched version of `encode_single()`. Uses multiprocessing on all CPU cores for preprocessing,
+        and multithreading for tokenization if a `FastTokenizer` is used
+        Inputs:
+            sentences: a list of sentences to encode
+            multiprocessing_threshold: for input batches smaller than this value, multiprocessing will not be used due to its overhead
+        """
+        batch_numerical, batch_length = self._encode_token_ids(sentences, multiprocessing_threshold)
 
         batch_decoder_numerical = []
         if self.decoder_vocab:
-            for i in range(len(batch_numerical)):
-                batch_decoder_numerical.append(self.decoder_vocab.encode(batch_numerical[i]))
+            # encode all sentences at once, then split them again
+            all_decoder_numerical = self.decoder_vocab.encode([idx for numerical in batch_numerical for idx in numerical])
+            start = 0
+            for numerical in batch_numerical:
+                batch_decoder_numerical.append(all_decoder_numerical[start:start+len(numerical)])
+                start += len(numerical)
         else:
             batch_decoder_numerical = [[]] * len(batch_numerical)
 
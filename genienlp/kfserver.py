@@ -32,21 +32,18 @@ import logging
 
 import kfserving
 
-from .util import log_model_size
 from .server import Server, init
 
 logger = logging.getLogger(__name__)
 
 
 class KFModelServer(kfserving.KFModel):
-    def __init__(self, name, args, numericalizer, model, device, confidence_estimator):
+    def __init__(self, name, args, registry):
         super().__init__(name)
-        self.server = Server(args, numericalizer, model, device, confidence_estimator)
+        self.server = Server(args, registry)
 
     def load(self):
-        log_model_size(logger, self.server.model, self.server.args.model)
-        self.server.model.to(self.server.device)
-        self.server.model.eval()
+        # the default model is already loaded by init(), other models are loaded when they are first used
         self.ready = True
 
     def predict(self, request):
@@ -55,7 +52,8 @@ class KFModelServer(kfserving.KFModel):
 
 
 def main(args):
-    model, device, confidence_estimator = init(args)
-    model_server = KFModelServer(args.inference_name, args, model.numericalizer, model, device, confidence_estimator)
+    registry = init(args)
+    model_server = KFModelServer(args.inference_name, args, registry)
     model_server.load()
-    kfserving.KFServer(workers=1).start([model_server])
+    # KFServer forks its workers after the default model is loaded, so they share its weights copy-on-write
+    kfserving.KFServer(workers=args.workers).start([model_server])
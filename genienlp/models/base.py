@@ -73,7 +73,167 @@ class GenieModel(PreTrainedModel):
             self.numericalizer.build_vocab(vocab_sets, tasks)
 
     def add_new_vocab_from_data(self, tasks, resize_decoder=False):
+        """
+        Returns True if new tokens were added to the vocabulary, in which case subclasses resize their embeddings
+        """
         old_num_tokens = self.numericalizer.num_tokens
         self.numericalizer.grow_vocab(tasks)
         if self.numericalizer.num_tokens > old_num_tokens:
             logger.info(f'Vocabulary has expanded to {self.numericalizer.num_tokens} tokens')
+            return True
+        return False
+
+    def encode(self, batch):
+        """
+        Runs the encoder on `batch`. The output can be passed to generate() as `encoder_output`,
+        to decode the same batch multiple times without running the encoder again
+        """
+        raise NotImplementedError()
+
+    def _prepare_stream(self, batch, max_output_length, encoder_output=None):
+        """
+        Returns the `transformers` model that decodes one step at a time, the initial decoder input ids, the model kwargs
+        and the pad and EOS token ids, as used by `generate_stream()`.
+        `encoder_output` is the output of `encode()`, if it is already known
+        """
+        raise NotImplementedError()
+
+    def _compact_model_kwargs(self, model_kwargs, keep):
+        """
+        Keeps only the rows `keep` of the decoder states and encoder outputs in `model_kwargs`, and returns the new model kwargs
+        """
+        raise NotImplementedError()
+
+    def _output_shortlist(self, batch):
+        """
+        Returns the sorted ids of the only tokens the decoder can generate for `batch`, or None if it can generate any token
+        """
+        return None
+
+    def _restricted_model(self, model, shortlist):
+        """
+        Returns a model that computes the same logits as `model`, but for the tokens in `shortlist` only, in that order.
+        `model` itself must not be modified
+        """
+        raise NotImplementedError()
+
+    def _map_streamed_tokens(self, generated):
+        """
+        Maps the tokens generated by `generate_stream()` to ids that `numericalizer.reverse()` understands
+        """
+        return generated
+
+    @torch.no_grad()
+    def generate_stream(self,
+                        batch,
+                        max_output_length,
+                        temperature,
+                        repetition_penalty,
+                        top_k,
+                        top_p,
+                        no_repeat_ngram_size,
+                        do_sample
+                        ):
+        """
+        Greedy decoding or sampling, one token at a time.
+        This mirrors what `transformers` does in generate() when num_beams == 1, but yields the tokens generated so far after each step.
+        The last yielded value is the same output generate() would return.
+        """
+        for output in self._decode_steps(batch, max_output_length, temperature, repetition_penalty, top_k, top_p,
+                                         no_repeat_ngram_size, do_sample):
+            yield self._map_streamed_tokens(output)
+
+    @torch.no_grad()
+    def _greedy_or_sample_generate(self,
+                                   batch,
+                                   max_output_length,
+                                   temperature,
+                                   repetition_penalty,
+                                   top_k,
+                                   top_p,
+                                   no_repeat_ngram_size,
+                                   do_sample,
+                                   encoder_output=None
+                                   ):
+        """
+        Same as generate() with num_beams == 1 and num_outputs == 1, but sequences leave the batch as soon as they are finished
+        """
+        for output in self._decode_steps(batch, max_output_length, temperature, repetition_penalty, top_k, top_p,
+                                         no_repeat_ngram_size, do_sample, encoder_output):
+            pass
+        return self._map_streamed_tokens(output)
+
+    def _decode_steps(self,
+                      batch,
+                      max_output_length,
+                      temperature,
+                      repetition_penalty,
+                      top_k,
+                      top_p,
+                      no_repeat_ngram_size,
+                      do_sample,
+                      encoder_output=None
+                      ):
+        """
+        The decoding loop of `generate_stream()` and `_greedy_or_sample_generate()`. Yields the output of the whole batch after each step.
+        Whenever some sequences finish, their rows are removed from the decoder input, the decoder states and the encoder outputs,
+        so that the remaining steps only cost as much as the sequences that are still being generated.
+        Finished sequences are padded in the output, like `transformers` does.
+        """
+        model, generated, model_kwargs, pad_token_id, eos_token_id = self._prepare_stream(batch, max_output_length, encoder_output)
+        shortlist = self._output_shortlist(batch)
+        processor_eos_token_id = eos_token_id
+        if shortlist is not None:
+            # logits only cover the shortlist, so the logits processors see the position of each token in the shortlist
+            # instead of its id, and so does the token that is picked
+            to_shortlist = shortlist.new_zeros(shortlist[-1].item() + 1)
+            to_shortlist[shortlist] = torch.arange(len(shortlist), device=shortlist.device)
+            processor_eos_token_id = to_shortlist[eos_token_id].item()
+        logits_processor = model._get_logits_processor(repetition_penalty=repetition_penalty,
+                                                       no_repeat_ngram_size=no_repeat_ngram_size,
+                                                       bad_words_ids=None,
+                                                       min_length=2, # generate at least one token after BOS
+                                                       eos_token_id=processor_eos_token_id,
+                                                       prefix_allowed_tokens_fn=None,
+                                                       num_beams=1,
+                                                       num_beam_groups=1,
+                                                       diversity_penalty=0.0)
+        if do_sample:
+            logits_warper = model._get_logits_warper(top_k=top_k, top_p=top_p, temperature=temperature, num_beams=1)
+
+        batch_size, cur_len = generated.shape
+        output = generated.new_full((batch_size, max_output_length), pad_token_id)
+        output[:, :cur_len] = generated
+        # for each row of `generated`, the row of `output` it corresponds to
+        active_rows = torch.arange(batch_size, device=generated.device)
+        # the model that computes the logits of the shortlist only, if there is one
+        logits_model = model if shortlist is None else self._restricted_model(model, shortlist)
+        while cur_len < max_output_length:
+            model_inputs = model.prepare_inputs_for_generation(generated, **model_kwargs)
+            outputs = logits_model(**model_inputs, return_dict=True)
+            next_token_logits = outputs.logits[:, -1, :]
+            processor_input_ids = generated if shortlist is None else to_shortlist[generated]
+            scores = logits_processor(processor_input_ids, next_token_logits)
+            if do_sample:
+                scores = logits_warper(processor_input_ids, scores)
+                next_tokens = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+            else:
+                next_tokens = torch.argmax(scores, dim=-1)
+            if shortlist is not None:
+                next_tokens = shortlist[next_tokens]
+
+            output[active_rows, cur_len] = next_tokens
+            generated = torch.cat([generated, next_tokens[:, None]], dim=-1)
+            cur_len += 1
+            model_kwargs = model._update_model_kwargs_for_generation(outputs, model_kwargs,
+                                                                     is_encoder_decoder=model.config.is_encoder_decoder)
+
+            yield output[:, :cur_len]
+            unfinished = next_tokens != eos_token_id
+            if not unfinished.all():
+                if not unfinished.any():
+                    break
+                keep = unfinished.nonzero(as_tuple=True)[0]
+                active_rows = active_rows[keep]
+                generated = generated[keep]
+                model_kwargs = self._compact_model_kwargs(model_kwargs, keep)
@@ -71,7 +71,7 @@ class MQANDecoder(nn.Module):
         context, context_limited = batch.context.value, batch.context.limited
         answer, answer_limited = batch.answer.value, batch.answer.limited
         decoder_vocab = self.numericalizer.decoder_vocab
-        self.map_to_full = decoder_vocab.decode
+        self.map_to_full = decoder_vocab.decode_tensor
         context_padding = context.data == self.pad_idx
         if self.training:
             if self.args.rnn_layers > 0:
@@ -107,7 +107,7 @@ class MQANDecoder(nn.Module):
                                                        context_limited, decoder_vocab, rnn_state=context_rnn_state,
                                                        expansion_factor=expansion_factor, generation_dict=generation_dict)
             else:
-                current_token_id = current_token_id.clone().cpu().apply_(self.map_to_full).to(current_token_id.device)
+                current_token_id = self.map_to_full(current_token_id)
             # (next_token_logits, past) where `past` includes all the states needed to continue generation
             logits = torch.log(decoder_wrapper.next_token_probs(current_token_id))
             return Seq2SeqLMOutput(logits=logits, past_key_values=decoder_wrapper)
@@ -132,6 +132,32 @@ class MQANDecoder(nn.Module):
 
         return scaled_p_vocab
 
+    def candidate_probs(self, outputs, vocab_pointer_switches, context_attention, context_indices, first_occurrences, k):
+        """
+        The same distribution as `probs()`, but only for the `k` most likely tokens of the generative vocabulary and for the tokens
+        of the context, which together always include the `k` most likely tokens overall.
+        The softmax over the generative vocabulary is still computed in full; only extending it to the whole decoder vocabulary
+        and scattering the copy probabilities into it are skipped.
+        first_occurrences: for each position of the context, the first position of the context with the same token
+        Returns the ids of these tokens and their probabilities, both of shape (batch, decoder_time, k + encoder_time).
+        Tokens can appear more than once, with the same probability each time except among the first `k`,
+        where tokens of the context only have their generative probability.
+        """
+        scores = self.out(outputs)
+        p_vocab = F.softmax(scores, dim=scores.dim() - 1)
+        top_probs, top_ids = p_vocab.topk(k, dim=-1)
+
+        context_ids = context_indices.unsqueeze(1).expand_as(context_attention)
+        # probabilities of the tokens of the context as in probs(): EPSILON for tokens outside of the generative vocabulary,
+        # plus the attention of all the positions where the token appears
+        context_probs = (vocab_pointer_switches * p_vocab.gather(-1, context_ids.clamp(max=self.generative_vocab_size - 1)))
+        context_probs = context_probs.masked_fill(context_ids >= self.generative_vocab_size, EPSILON)
+        copy_probs = (1 - vocab_pointer_switches) * context_attention
+        first_occurrences = first_occurrences.unsqueeze(1).expand_as(context_attention)
+        copy_probs = torch.zeros_like(copy_probs).scatter_add_(-1, first_occurrences, copy_probs).gather(-1, first_occurrences)
+
+        return torch.cat([top_ids, context_ids], dim=-1), torch.cat([vocab_pointer_switches * top_probs, context_probs + copy_probs], dim=-1)
+
     def decoder_wrapper(self, context, context_padding, context_indices,
                         decoder_vocab, rnn_state=None, expansion_factor=1, generation_dict=None):
         batch_size = context.size()[0]
@@ -162,31 +188,43 @@ class LSTMDecoder(nn.Module):
     def applyMasks(self, context_mask):
         self.context_attn.applyMasks(context_mask)
 
-    def forward(self, input: torch.Tensor, context, output=None, hidden=None):
-        context_output = output if output is not None else self.make_init_output(context)
+    def forward(self, input: torch.Tensor, context, output=None, hidden=None, num_beams=1):
+        """
+        num_beams: if greater than 1, each row of `context` is the context of `num_beams` consecutive rows of `input`
+        """
+        context_output = output if output is not None else self.make_init_output(input)
 
-        context_outputs, vocab_pointer_switch_inputs, context_attentions = [], [], []
-        for decoder_input in input.split(1, dim=1):
+        # the input is split and the outputs of each step are stacked once at the end; indexing the input or writing into
+        # preallocated buffers at each step would make autograd copy a gradient as large as the whole sequence for each step
+        dec_states, attended_outputs, context_outputs, context_attentions = [], [], [], []
+        for decoder_input in input.unbind(1):
             context_output = self.dropout(context_output)
             if self.input_feed:
-                rnn_input = torch.cat([decoder_input, context_output], 2)
+                rnn_input = torch.cat([decoder_input, context_output.squeeze(1)], 1)
             else:
                 rnn_input = decoder_input
 
-            rnn_input = rnn_input.squeeze(1)
             dec_state, hidden = self.rnn(rnn_input, hidden)
-            dec_state = dec_state.unsqueeze(1)
-
-            context_output, context_attention = self.context_attn(dec_state, context)
-            vocab_pointer_switch_inputs.append(torch.cat([dec_state, context_output, decoder_input], -1))
+            context_output, context_attention = self._attend(dec_state.unsqueeze(1), context, num_beams)
+            dec_states.append(dec_state)
+            attended_outputs.append(context_output.squeeze(1))
 
             context_output = self.dropout(context_output)
-            context_outputs.append(context_output)
-            context_attentions.append(context_attention)
-
-        return [torch.cat(x, dim=1) for x in (context_outputs,
-                                              vocab_pointer_switch_inputs,
-                                              context_attentions)] + [hidden]
+            context_outputs.append(context_output.squeeze(1))
+            context_attentions.append(context_attention.squeeze(1))
+
+        # the inputs of the pointer switch are each step's decoder state, context output and decoder input, side by side
+        vocab_pointer_switch_inputs = torch.cat([torch.stack(dec_states, dim=1), torch.stack(attended_outputs, dim=1), input], dim=-1)
+        return [torch.stack(context_outputs, dim=1), vocab_pointer_switch_inputs, torch.stack(context_attentions, dim=1), hidden]
+
+    def _attend(self, dec_state, context, num_beams):
+        if num_beams == 1:
+            return self.context_attn(dec_state, context)
+        # the beams of each input attend to its context together, as if they were consecutive decoder steps,
+        # so that the context does not need to be copied for each beam
+        batch_size = dec_state.size(0)
+        context_output, context_attention = self.context_attn(dec_state.view(batch_size // num_beams, num_beams, -1), context)
+        return context_output.view(batch_size, 1, -1), context_attention.view(batch_size, 1, -1)
 
     def make_init_output(self, context):
         batch_size = context.size(0)
@@ -202,9 +240,9 @@ class MQANDecoderWrapper(object):
     def __init__(self, context, context_padding, context_indices,
                  decoder_vocab, rnn_state, batch_size, max_decoder_time, mqan_decoder: MQANDecoder, expansion_factor:int):
         self.decoder_vocab = decoder_vocab
-        context = self.expand_for_beam_search(context, batch_size, expansion_factor)
-        context_padding = self.expand_for_beam_search(context_padding, batch_size, expansion_factor)
-        context_indices = self.expand_for_beam_search(context_indices, batch_size, expansion_factor)
+        # the context of each input is shared by all its beams and is never expanded,
+        # only the state of each beam is
+        self.num_beams = expansion_factor
         if rnn_state is not None:
             rnn_state = self.expand_for_beam_search(rnn_state, batch_size, expansion_factor, dim=1)
         self.context = context
@@ -222,39 +260,84 @@ class MQANDecoderWrapper(object):
 
         self.time = 0
         self.decoder_output = None
+        # only computed for `next_token_candidates()`
+        self.first_occurrences = None
 
     def reorder(self, new_order):
-        # TODO only reordering rnn_state should be enough since reordering happens among beams of the same input
-        self.context = self.reorder_for_beam_search(self.context, new_order)
-        self.context_padding = self.reorder_for_beam_search(self.context_padding, new_order)
-        self.context_indices = self.reorder_for_beam_search(self.context_indices, new_order)
-        self.rnn_state = self.reorder_for_beam_search(self.rnn_state, new_order, dim=1)
+        # reordering only happens among beams of the same input, which share the same context
+        # so only the state of each beam needs to be reordered
+        if self.rnn_state is not None:
+            self.rnn_state = self.reorder_for_beam_search(self.rnn_state, new_order, dim=1)
+        if self.decoder_output is not None:
+            self.decoder_output = self.reorder_for_beam_search(self.decoder_output, new_order)
+
+    def select(self, rows):
+        """
+        Keeps only `rows` of the batch, for example when the other sequences are finished.
+        Without beams, each row is a different input, so its context is removed as well
+        """
+        assert self.num_beams == 1, 'Inputs cannot be removed from beam search'
+        self.context = self.context[rows]
+        self.context_padding = self.context_padding[rows]
+        self.context_indices = self.context_indices[rows]
+        if self.first_occurrences is not None:
+            self.first_occurrences = self.first_occurrences[rows]
+        self.reorder(rows)
 
         if self.mqan_decoder.args.rnn_layers > 0:
-                self.mqan_decoder.rnn_decoder.applyMasks(self.context_padding)
+            self.mqan_decoder.rnn_decoder.applyMasks(self.context_padding)
         else:
             self.mqan_decoder.context_attn.applyMasks(self.context_padding)
 
     def next_token_probs(self, current_token_id):
+        decoder_output, vocab_pointer_switch, context_attention = self._step(current_token_id)
+        probs = self.mqan_decoder.probs(decoder_output, vocab_pointer_switch, context_attention,
+                                        self.context_indices, self.decoder_vocab)
+        # one row per beam, like the decoder input
+        return probs.view(-1, 1, probs.size(-1))
+
+    def next_token_candidates(self, current_token_id, k):
+        """
+        Same as `next_token_probs()`, but returns the ids and probabilities of the candidates of `MQANDecoder.candidate_probs()`
+        instead of the whole distribution, each of shape (batch_size, 1, k + encoder_time)
+        """
+        if self.first_occurrences is None:
+            positions = torch.arange(self.context_indices.size(1), device=self.context_indices.device)
+            same_token = self.context_indices.unsqueeze(2) == self.context_indices.unsqueeze(1)
+            self.first_occurrences = torch.where(same_token, positions, positions.new_tensor(len(positions))).min(dim=2)[0]
+        decoder_output, vocab_pointer_switch, context_attention = self._step(current_token_id)
+        ids, probs = self.mqan_decoder.candidate_probs(decoder_output, vocab_pointer_switch, context_attention,
+                                                       self.context_indices, self.first_occurrences, k)
+        return ids.view(-1, 1, ids.size(-1)), probs.view(-1, 1, probs.size(-1))
+
+    def _step(self, current_token_id):
+        """
+        Runs the decoder for one step, and returns its output, the vocabulary pointer switch and the context attention,
+        with the beams of each input grouped along the second dimension
+        """
         embedding = self.mqan_decoder.decoder_embeddings(current_token_id)
+        # attention and copying see the beams of each input as if they were consecutive decoder steps of that input
+        grouped_size = (self.context.size(0), self.num_beams, -1)
 
         if self.mqan_decoder.args.rnn_layers > 0:
-            rnn_decoder_outputs = self.mqan_decoder.rnn_decoder(embedding, self.context,
-                                                                hidden=self.rnn_state, output=self.decoder_output)
+            rnn_decoder_outputs = self.mqan_decoder.rnn_decoder(embedding, self.context, hidden=self.rnn_state,
+                                                                output=self.decoder_output, num_beams=self.num_beams)
             self.decoder_output, vocab_pointer_switch_input, context_attention, self.rnn_state = rnn_decoder_outputs
+            decoder_output = self.decoder_output.view(grouped_size)
+            vocab_pointer_switch_input = vocab_pointer_switch_input.view(grouped_size)
+            context_attention = context_attention.view(grouped_size)
         else:
+            embedding = embedding.view(grouped_size)
             context_decoder_output, context_attention = self.mqan_decoder.context_attn(embedding, self.context)
             vocab_pointer_switch_input = torch.cat((context_decoder_output, embedding), dim=-1)
 
-            self.decoder_output = self.mqan_decoder.dropout(context_decoder_output)
+            decoder_output = self.mqan_decoder.dropout(context_decoder_output)
+            self.decoder_output = decoder_output.view(-1, 1, decoder_output.size(-1))
 
         vocab_pointer_switch = self.mqan_decoder.vocab_pointer_switch(vocab_pointer_switch_input)
 
-        probs = self.mqan_decoder.probs(self.decoder_output, vocab_pointer_switch, context_attention,
-                                        self.context_indices, self.decoder_vocab)
-
         self.time += 1
-        return probs
+        return decoder_output, vocab_pointer_switch, context_attention
 
     def expand_for_beam_search(self, t, batch_size, num_beams, dim=0):
         if isinstance(t, tuple):
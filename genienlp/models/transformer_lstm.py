@@ -75,8 +75,8 @@ class TransformerLSTM(GenieModel):
         self.decoder = MQANDecoder(self.numericalizer, args)
 
     def add_new_vocab_from_data(self, tasks, resize_decoder=False):
-        super().add_new_vocab_from_data(tasks, resize_decoder=resize_decoder)
-        self.encoder_embeddings.resize_token_embeddings(self.numericalizer.num_tokens)
+        if super().add_new_vocab_from_data(tasks, resize_decoder=resize_decoder):
+            self.encoder_embeddings.resize_token_embeddings(self.numericalizer.num_tokens)
         if resize_decoder:
             self.decoder.decoder_embeddings.resize_embedding(self.numericalizer.num_tokens)
             
@@ -150,10 +150,18 @@ class TransformerLSTM(GenieModel):
                  num_beam_groups,
                  diversity_penalty,
                  no_repeat_ngram_size,
-                 do_sample
+                 do_sample,
+                 encoder_output=None
                  ):
 
-        encoder_output = self.encoder(batch)
+        if num_beams == 1 and num_outputs == 1 and not do_sample and repetition_penalty == 1.0 and no_repeat_ngram_size == 0:
+            return self._candidate_greedy_generate(batch, max_output_length, encoder_output)
+        if num_beams == 1 and num_outputs == 1:
+            return self._greedy_or_sample_generate(batch, max_output_length, temperature, repetition_penalty, top_k, top_p,
+                                                   no_repeat_ngram_size, do_sample, encoder_output)
+
+        if encoder_output is None:
+            encoder_output = self.encode(batch)
         self.config.vocab_size = len(self.numericalizer.decoder_vocab)
         self.config.is_encoder_decoder = False # in order to make it work with `transformers` generation code, we should treat this as a decoder-only model
         batch_size = len(batch.example_id)
@@ -180,6 +188,78 @@ class TransformerLSTM(GenieModel):
                                      generation_dict={'max_output_length': max_output_length},
                                      encoder_output=encoder_output
                                     )
-        generated = torch.cat((generated[:, 0:1], generated[:, 1:].cpu().apply_(self.decoder.map_to_full).to(batch.context.value.device)), dim=1) # map everything to full vocabulary except BOS which already is in full vocabulary
+        generated = torch.cat((generated[:, 0:1], self.decoder.map_to_full(generated[:, 1:])), dim=1) # map everything to full vocabulary except BOS which already is in full vocabulary
 
         return generated
+
+    @torch.no_grad()
+    def _candidate_greedy_generate(self, batch, max_output_length, encoder_output=None):
+        """
+        Greedy decoding that picks each token among the most likely tokens of the generative vocabulary and the tokens of the input,
+        instead of building the distribution over the whole decoder vocabulary. The output is the same as generate().
+        Like `_greedy_or_sample_generate()`, finished sequences leave the batch
+        """
+        if encoder_output is None:
+            encoder_output = self.encode(batch)
+        final_context, context_rnn_state = encoder_output
+        decoder_vocab = self.numericalizer.decoder_vocab
+        context_padding = batch.context.value == self.decoder.pad_idx
+        decoder_wrapper = self.decoder.decoder_wrapper(final_context, context_padding, batch.context.limited, decoder_vocab,
+                                                       rnn_state=context_rnn_state,
+                                                       generation_dict={'max_output_length': max_output_length})
+
+        batch_size = len(batch.example_id)
+        device = batch.context.value.device
+        output = torch.full((batch_size, max_output_length), decoder_vocab.pad_idx, dtype=torch.long, device=device)
+        # BOS is already in the full vocabulary
+        current_token_id = torch.full((batch_size, 1), self.decoder.init_idx, dtype=torch.long, device=device)
+        active_rows = torch.arange(batch_size, device=device)
+        cur_len = 1
+        while cur_len < max_output_length:
+            # the two most likely generative tokens, in case the first one is EOS and cannot be generated yet
+            token_ids, token_probs = decoder_wrapper.next_token_candidates(current_token_id, k=2)
+            token_ids, token_probs = token_ids.squeeze(1), token_probs.squeeze(1)
+            if cur_len == 1:
+                # generate at least one token after BOS, like min_length=2 in generate()
+                token_probs = token_probs.masked_fill(token_ids == decoder_vocab.eos_idx, -1)
+            next_tokens = token_ids.gather(1, token_probs.argmax(dim=1, keepdim=True)).squeeze(1)
+
+            output[active_rows, cur_len] = next_tokens
+            cur_len += 1
+            unfinished = next_tokens != decoder_vocab.eos_idx
+            if not unfinished.all():
+                if not unfinished.any():
+                    break
+                keep = unfinished.nonzero(as_tuple=True)[0]
+                active_rows = active_rows[keep]
+                next_tokens = next_tokens[keep]
+                decoder_wrapper.select(keep)
+            current_token_id = decoder_vocab.decode_tensor(next_tokens).unsqueeze(1)
+
+        output = output[:, :cur_len]
+        return torch.cat((current_token_id.new_full((batch_size, 1), self.decoder.init_idx), decoder_vocab.decode_tensor(output[:, 1:])), dim=1)
+
+    @torch.no_grad()
+    def encode(self, batch):
+        return self.encoder(batch)
+
+    def _prepare_stream(self, batch, max_output_length, encoder_output=None):
+        if encoder_output is None:
+            encoder_output = self.encode(batch)
+        self.config.vocab_size = len(self.numericalizer.decoder_vocab)
+        self.config.is_encoder_decoder = False # the decoder is driven one token at a time, like a decoder-only model
+        batch_size = len(batch.example_id)
+        generated = torch.full((batch_size, 1), self.decoder.init_idx, dtype=torch.long, device=batch.context.value.device)
+        model_kwargs = {'attention_mask': torch.ones_like(generated), 'use_cache': True, 'batch': batch,
+                        'generation_dict': {'max_output_length': max_output_length}, 'encoder_output': encoder_output}
+        return self, generated, model_kwargs, self.numericalizer.decoder_vocab.pad_idx, self.numericalizer.decoder_vocab.eos_idx
+
+    def _compact_model_kwargs(self, model_kwargs, keep):
+        model_kwargs['attention_mask'] = model_kwargs['attention_mask'][keep]
+        # the decoder wrapper holds the encoder outputs and the recurrent state
+        model_kwargs['past'].select(keep)
+        return model_kwargs
+
+    def _map_streamed_tokens(self, generated):
+        # map everything to full vocabulary except BOS which already is in full vocabulary
+        return torch.cat((generated[:, 0:1], self.decoder.map_to_full(generated[:, 1:])), dim=1)
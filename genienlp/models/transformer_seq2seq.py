@@ -27,11 +27,14 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import copy
 import logging
+from collections import OrderedDict
 from typing import List
 import torch
 from torch.tensor import Tensor
-from transformers import AutoModelForSeq2SeqLM, AutoConfig
+from transformers import AutoModelForSeq2SeqLM, AutoConfig, BeamSearchScorer
+from transformers.modeling_outputs import BaseModelOutput
 from loss_dropper import LossDropper
 
 from ..data_utils.numericalizer import TransformerNumericalizer
@@ -41,6 +44,27 @@ from ..util import ConfidenceFeatures
 
 logger = logging.getLogger(__name__)
 
+# upper bound on the number of logits computed at once by confidence_features() for MC dropout, about 512MB in float32
+MAX_CONFIDENCE_LOGITS = 2**27
+
+# longest suffix of the output that speculative decoding looks up in the input to draft the next tokens
+MAX_DRAFT_NGRAM = 3
+
+
+class ShortlistHead(torch.nn.Module):
+    """
+    A language modeling head that only computes the logits of some tokens, given the rows of the full head for those tokens
+    """
+
+    def __init__(self, weight, bias=None):
+        super().__init__()
+        # plain tensors instead of parameters, since they are only used for decoding
+        self.weight = weight
+        self.bias = bias
+
+    def forward(self, hidden_states):
+        return torch.nn.functional.linear(hidden_states, self.weight, self.bias)
+
 
 class TransformerSeq2Seq(GenieModel):
     def __init__(self, config=None, *inputs, args, tasks, vocab_sets, save_directory=None, **kwargs):
@@ -58,7 +82,9 @@ class TransformerSeq2Seq(GenieModel):
                                                                cache_dir=self.args.embeddings)
             
         self.numericalizer = TransformerNumericalizer(self.args.pretrained_model, max_generative_vocab=None,
-                                                      preprocess_special_tokens=args.preprocess_special_tokens)
+                                                      preprocess_special_tokens=args.preprocess_special_tokens,
+                                                      build_output_shortlist=getattr(args, 'decoder_shortlist', False),
+                                                      build_answer_ngrams=getattr(args, 'draft_ngram_table', False))
 
         self.init_vocab_from_data(vocab_sets, tasks, save_directory)
         self.model.resize_token_embeddings(self.numericalizer.num_tokens)
@@ -70,8 +96,8 @@ class TransformerSeq2Seq(GenieModel):
             
             
     def add_new_vocab_from_data(self, tasks, resize_decoder=False):
-        super().add_new_vocab_from_data(tasks, resize_decoder)
-        self.model.resize_token_embeddings(self.numericalizer.num_tokens)
+        if super().add_new_vocab_from_data(tasks, resize_decoder):
+            self.model.resize_token_embeddings(self.numericalizer.num_tokens)
     
     
     def set_decoder_start_token_id(self, lang):
@@ -132,16 +158,29 @@ class TransformerSeq2Seq(GenieModel):
                  num_beam_groups,
                  diversity_penalty,
                  no_repeat_ngram_size,
-                 do_sample
+                 do_sample,
+                 encoder_output=None
                  ):
         
         decoder_start_token_id = None
         if self._is_mbart:
             decoder_start_token_id = self.model.config.decoder_start_token_id
 
-        input_ids = batch.context.value
+        if getattr(self.args, 'num_draft_tokens', 0) > 0 and num_beams == 1 and num_outputs == 1 and not do_sample:
+            return self._speculative_greedy_generate(batch, max_output_length, repetition_penalty, no_repeat_ngram_size,
+                                                     decoder_start_token_id, encoder_output)
+        if num_beams == 1 and num_outputs == 1:
+            return self._greedy_or_sample_generate(batch, max_output_length, temperature, repetition_penalty, top_k, top_p,
+                                                   no_repeat_ngram_size, do_sample, encoder_output)
+
+        # beam search and multiple outputs always compute the logits of the whole vocabulary, --decoder_shortlist does not apply
+        if encoder_output is not None:
+            return self._generate_from_encoder_output(encoder_output, max_output_length, num_outputs, temperature,
+                                                      repetition_penalty, top_k, top_p, num_beams, num_beam_groups,
+                                                      diversity_penalty, no_repeat_ngram_size, do_sample, decoder_start_token_id)
+
         # when attention_mask is not provided to generate(), it will default to masking pad tokens, which is the correct thing
-        generated = self.model.generate(input_ids=input_ids,
+        generated = self.model.generate(input_ids=batch.context.value,
                                         max_length=max_output_length,
                                         min_length=2, # generate at least one token after BOS
                                         bos_token_id=self.numericalizer._tokenizer.bos_token_id,
@@ -163,12 +202,283 @@ class TransformerSeq2Seq(GenieModel):
 
         return generated
 
+    @torch.no_grad()
+    def _generate_from_encoder_output(self, encoder_output, max_output_length, num_outputs, temperature, repetition_penalty,
+                                      top_k, top_p, num_beams, num_beam_groups, diversity_penalty, no_repeat_ngram_size,
+                                      do_sample, decoder_start_token_id):
+        """
+        Does what `self.model.generate()` does after running the encoder, starting from `encoder_output` instead.
+        `transformers` 4.1 always runs the encoder in generate(), even when `encoder_outputs` is provided, so we
+        call the search methods directly
+        """
+        encoder_outputs, attention_mask = encoder_output
+        tokenizer = self.numericalizer._tokenizer
+        pad_token_id = tokenizer.pad_token_id
+        eos_token_id = tokenizer.eos_token_id
+        batch_size = attention_mask.shape[0]
+        device = attention_mask.device
+        logits_processor = self.model._get_logits_processor(repetition_penalty=repetition_penalty,
+                                                            no_repeat_ngram_size=no_repeat_ngram_size,
+                                                            bad_words_ids=None,
+                                                            min_length=2, # generate at least one token after BOS
+                                                            eos_token_id=eos_token_id,
+                                                            prefix_allowed_tokens_fn=None,
+                                                            num_beams=num_beams,
+                                                            num_beam_groups=num_beam_groups,
+                                                            diversity_penalty=diversity_penalty)
+
+        # each example is repeated once per beam and per output, the same way generate() does it
+        if num_beams == 1:
+            expand_size = num_outputs
+        elif do_sample:
+            expand_size = num_beams * num_outputs
+        else:
+            expand_size = num_beams
+        expanded_index = torch.arange(batch_size, device=device).repeat_interleave(expand_size)
+        decoder_start_token_id = self.model._get_decoder_start_token_id(decoder_start_token_id, tokenizer.bos_token_id)
+        input_ids = torch.full((batch_size * expand_size, 1), decoder_start_token_id, dtype=torch.long, device=device)
+        # index_select() makes new tensors, so the caller's encoder outputs can be reused for another call
+        model_kwargs = {'encoder_outputs': BaseModelOutput(last_hidden_state=encoder_outputs.last_hidden_state.index_select(0, expanded_index)),
+                        'attention_mask': attention_mask.index_select(0, expanded_index),
+                        'use_cache': True}
+
+        if num_beams == 1:
+            if not do_sample:
+                raise ValueError('num_outputs has to be 1 when doing greedy search, but is {}.'.format(num_outputs))
+            logits_warper = self.model._get_logits_warper(top_k=top_k, top_p=top_p, temperature=temperature, num_beams=num_beams)
+            return self.model.sample(input_ids, logits_processor=logits_processor, logits_warper=logits_warper,
+                                     max_length=max_output_length, pad_token_id=pad_token_id, eos_token_id=eos_token_id,
+                                     **model_kwargs)
+
+        length_penalty = self.model.config.length_penalty
+        if do_sample:
+            if num_beam_groups > 1:
+                raise ValueError('Diverse beam search cannot be used in sampling mode.')
+            beam_scorer = BeamSearchScorer(batch_size=batch_size * num_outputs,
+                                           max_length=max_output_length,
+                                           num_beams=num_beams,
+                                           device=device,
+                                           length_penalty=length_penalty,
+                                           do_early_stopping=True)
+            logits_warper = self.model._get_logits_warper(top_k=top_k, top_p=top_p, temperature=temperature, num_beams=num_beams)
+            return self.model.beam_sample(input_ids, beam_scorer, logits_processor=logits_processor, logits_warper=logits_warper,
+                                          max_length=max_output_length, pad_token_id=pad_token_id, eos_token_id=eos_token_id,
+                                          **model_kwargs)
+
+        beam_scorer = BeamSearchScorer(batch_size=batch_size,
+                                       max_length=max_output_length,
+                                       num_beams=num_beams,
+                                       device=device,
+                                       length_penalty=length_penalty,
+                                       do_early_stopping=True,
+                                       num_beam_hyps_to_keep=num_outputs,
+                                       num_beam_groups=num_beam_groups)
+        search = self.model.group_beam_search if num_beam_groups > 1 else self.model.beam_search
+        return search(input_ids, beam_scorer, logits_processor=logits_processor, max_length=max_output_length,
+                      pad_token_id=pad_token_id, eos_token_id=eos_token_id, **model_kwargs)
 
-    def confidence_features(self, batch, predictions, mc_dropout=False, mc_dropout_num=0) -> List[ConfidenceFeatures]:
+    @staticmethod
+    def _draft_from_input(output, source, num_draft_tokens):
+        """
+        Finds the longest suffix of `output` (up to MAX_DRAFT_NGRAM tokens) that appears in `source`,
+        and returns the tokens that follow it there, which are likely to be copied next
+        """
+        for n in range(min(MAX_DRAFT_NGRAM, len(output)), 0, -1):
+            suffix = output[-n:]
+            for start in range(len(source) - n):
+                if source[start:start+n] == suffix:
+                    return source[start+n:start+n+num_draft_tokens]
+        return []
+
+    @staticmethod
+    def _draft_from_ngrams(output, answer_ngrams, num_draft_tokens):
+        """
+        Drafts tokens one at a time with the n-gram table of the training answers, using the longest suffix of
+        the output and of the tokens drafted so far that is in the table
+        """
+        draft = []
+        while len(draft) < num_draft_tokens:
+            context = output + draft
+            for n in range(min(MAX_DRAFT_NGRAM, len(context)), 0, -1):
+                next_token = answer_ngrams.get(tuple(context[-n:]))
+                if next_token is not None:
+                    draft.append(next_token)
+                    break
+            else:
+                break
+        return draft
+
+    def _draft(self, output, source, num_draft_tokens):
+        # copying from the input is preferred, because the input spans are specific to this example
+        draft = self._draft_from_input(output, source, num_draft_tokens)
+        if len(draft) == 0 and self.numericalizer.answer_ngrams is not None:
+            draft = self._draft_from_ngrams(output, self.numericalizer.answer_ngrams, num_draft_tokens)
+        return draft
+
+    @torch.no_grad()
+    def _speculative_greedy_generate(self, batch, max_output_length, repetition_penalty, no_repeat_ngram_size,
+                                     decoder_start_token_id, encoder_output):
+        """
+        Greedy decoding with prompt lookup: at each step, the next tokens are drafted by copying from the input
+        (or, if the model has one, with the n-gram table of the training answers), and the decoder checks all of them in one forward pass. We keep the drafted tokens that greedy decoding would have
+        generated anyway, plus the one token the decoder predicts after them, so the output is the same as greedy decoding
+        """
+        num_draft_tokens = self.args.num_draft_tokens
+        pad_token_id = self.numericalizer._tokenizer.pad_token_id
+        eos_token_id = self.numericalizer._tokenizer.eos_token_id
+        if encoder_output is None:
+            encoder_output = self.encode(batch)
+        encoder_outputs, attention_mask = encoder_output
+        shortlist = self._output_shortlist(batch)
+        processor_eos_token_id = eos_token_id
+        logits_model = self.model
+        if shortlist is not None:
+            # like in `_decode_steps()`, logits only cover the shortlist and the logits processors see positions in the shortlist.
+            # Drafted tokens that are not in the shortlist are never accepted, so they can be mapped to any position
+            to_shortlist = shortlist.new_zeros(self.numericalizer.num_tokens)
+            to_shortlist[shortlist] = torch.arange(len(shortlist), device=shortlist.device)
+            processor_eos_token_id = to_shortlist[eos_token_id].item()
+            logits_model = self._restricted_model(self.model, shortlist)
+        logits_processor = self.model._get_logits_processor(repetition_penalty=repetition_penalty,
+                                                            no_repeat_ngram_size=no_repeat_ngram_size,
+                                                            bad_words_ids=None,
+                                                            min_length=2, # generate at least one token after BOS
+                                                            eos_token_id=processor_eos_token_id,
+                                                            prefix_allowed_tokens_fn=None,
+                                                            num_beams=1,
+                                                            num_beam_groups=1,
+                                                            diversity_penalty=0.0)
+
+        batch_size = batch.context.value.shape[0]
+        device = batch.context.value.device
+        sources = [batch.context.value[i, :batch.context.length[i]].tolist() for i in range(batch_size)]
+        decoder_start_token_id = self.model._get_decoder_start_token_id(decoder_start_token_id, self.numericalizer._tokenizer.bos_token_id)
+        generated = torch.full((batch_size, 1), decoder_start_token_id, dtype=torch.long, device=device)
+        outputs = [[decoder_start_token_id] for _ in range(batch_size)]
+        unfinished = [True] * batch_size
+        past = None
+        while generated.shape[1] < max_output_length:
+            cur_len = generated.shape[1]
+            # the decoder input ends at most at max_output_length tokens
+            max_drafts = min(num_draft_tokens, max_output_length - cur_len - 1)
+            drafts = [self._draft(outputs[i], sources[i], max_drafts) if unfinished[i] and past is not None else []
+                      for i in range(batch_size)]
+            num_drafts = max(len(d) for d in drafts)
+            draft_ids = torch.tensor([d + [pad_token_id] * (num_drafts - len(d)) for d in drafts], dtype=torch.long, device=device)
+            decoder_input_ids = torch.cat([generated if past is None else generated[:, -1:], draft_ids], dim=1)
+
+            model_output = logits_model(input_ids=None,
+                                        encoder_outputs=encoder_outputs,
+                                        attention_mask=attention_mask,
+                                        decoder_input_ids=decoder_input_ids,
+                                        past_key_values=past,
+                                        use_cache=True,
+                                        return_dict=True)
+            logits = model_output.logits[:, -(num_drafts+1):, :]
+
+            # the greedy prediction after each drafted token, assuming all the drafted tokens before it were accepted
+            predictions = []
+            for j in range(num_drafts + 1):
+                processor_input_ids = torch.cat([generated, draft_ids[:, :j]], dim=1)
+                if shortlist is not None:
+                    processor_input_ids = to_shortlist[processor_input_ids]
+                scores = logits_processor(processor_input_ids, logits[:, j, :])
+                predictions.append(torch.argmax(scores, dim=-1))
+            predictions = torch.stack(predictions, dim=1)
+            if shortlist is not None:
+                predictions = shortlist[predictions]
+
+            # accept the drafted tokens that match the predictions in all unfinished rows
+            matches = (predictions[:, :num_drafts] == draft_ids).cumprod(dim=1).sum(dim=1).tolist()
+            num_accepted = min(m for m, u in zip(matches, unfinished) if u)
+            new_tokens = predictions[:, :num_accepted+1].tolist()
+            for i in range(batch_size):
+                for j, token in enumerate(new_tokens[i]):
+                    if not unfinished[i]:
+                        # finished sequences are padded
+                        new_tokens[i][j] = pad_token_id
+                    elif token == eos_token_id:
+                        unfinished[i] = False
+                outputs[i] += new_tokens[i]
+            generated = torch.cat([generated, torch.tensor(new_tokens, dtype=torch.long, device=device)], dim=1)
+
+            # keep the decoder states of the accepted tokens only: self-attention keys and values are the first two
+            # of each layer, with shape (batch_size, num_heads, length, head_dim); cross-attention does not change
+            past = tuple(tuple(state[:, :, :cur_len+num_accepted, :] for state in layer_past[:2]) + tuple(layer_past[2:])
+                         for layer_past in model_output.past_key_values)
+
+            if not any(unfinished):
+                break
+
+        return generated
+
+    @torch.no_grad()
+    def encode(self, batch):
+        """
+        Returns the output of the encoder and the attention mask it used
+        """
+        input_ids = batch.context.value
+        pad_token_id = self.numericalizer._tokenizer.pad_token_id
+        attention_mask = self.model._prepare_attention_mask_for_generation(input_ids=input_ids, pad_token_id=pad_token_id, eos_token_id=self.numericalizer._tokenizer.eos_token_id)
+        encoder_outputs = self.model.get_encoder()(input_ids, attention_mask=attention_mask, return_dict=True)
+        return encoder_outputs, attention_mask
+
+    def _prepare_stream(self, batch, max_output_length, encoder_output=None):
+        decoder_start_token_id = None
+        if self._is_mbart:
+            decoder_start_token_id = self.model.config.decoder_start_token_id
+        decoder_start_token_id = self.model._get_decoder_start_token_id(decoder_start_token_id, self.numericalizer._tokenizer.bos_token_id)
+
+        input_ids = batch.context.value
+        pad_token_id = self.numericalizer._tokenizer.pad_token_id
+        eos_token_id = self.numericalizer._tokenizer.eos_token_id
+        if encoder_output is None:
+            attention_mask = self.model._prepare_attention_mask_for_generation(input_ids=input_ids, pad_token_id=pad_token_id, eos_token_id=eos_token_id)
+            # run the encoder once, the decoder reuses its output at every step
+            model_kwargs = self.model._prepare_encoder_decoder_kwargs_for_generation(input_ids, {'attention_mask': attention_mask, 'use_cache': True})
+        else:
+            encoder_outputs, attention_mask = encoder_output
+            model_kwargs = {'encoder_outputs': encoder_outputs, 'attention_mask': attention_mask, 'use_cache': True}
+        generated = torch.full((input_ids.shape[0], 1), decoder_start_token_id, dtype=torch.long, device=input_ids.device)
+        return self.model, generated, model_kwargs, pad_token_id, eos_token_id
+
+    def _output_shortlist(self, batch):
+        if not getattr(self.args, 'decoder_shortlist', False) or self.numericalizer.output_shortlist is None:
+            return None
+        input_ids = batch.context.value
+        # tokens of the input can be copied to the output even if they never appear in the training answers
+        return torch.cat([torch.tensor(self.numericalizer.output_shortlist, device=input_ids.device), input_ids.flatten()]).unique()
+
+    def _restricted_model(self, model, shortlist):
+        # `transformers` models always project the decoder output onto the whole vocabulary.
+        # We make a shallow copy of the model that shares all of its modules, except for the language modeling head
+        # and the final logits bias of BART models, which only have the rows of the shortlist.
+        # The model itself is not modified, so that other threads of the server can keep using it
+        restricted_model = copy.copy(model)
+        restricted_model._modules = OrderedDict(model._modules)
+        restricted_model._buffers = OrderedDict(model._buffers)
+        lm_head = model.lm_head
+        restricted_model.lm_head = ShortlistHead(lm_head.weight[shortlist], lm_head.bias[shortlist] if lm_head.bias is not None else None)
+        if getattr(model, 'final_logits_bias', None) is not None:
+            restricted_model.final_logits_bias = model.final_logits_bias[:, shortlist]
+        return restricted_model
+
+    def _compact_model_kwargs(self, model_kwargs, keep):
+        # indexing copies the tensors, so encoder outputs shared with other decoding configurations are left untouched
+        model_kwargs['encoder_outputs'] = BaseModelOutput(last_hidden_state=model_kwargs['encoder_outputs'].last_hidden_state[keep])
+        model_kwargs['attention_mask'] = model_kwargs['attention_mask'][keep]
+        # the keys and values of each layer all have the batch as their first dimension
+        model_kwargs['past'] = tuple(tuple(state[keep] for state in layer_past) for layer_past in model_kwargs['past'])
+        return model_kwargs
+
+
+    def confidence_features(self, batch, predictions, mc_dropout=False, mc_dropout_num=0, features=None) -> List[ConfidenceFeatures]:
         """
         predictions: Tensor of shape (batch_size, output_length)
         mc_dropout: if True, will activate dropout layers
         mc_droput_num: number of Monte Carlo samples used for the MC Dropout method
+        features: the fields of ConfidenceFeatures that are needed, as returned by `ConfidenceEstimator.required_features()`.
+                  If None, all of them are computed. The others are left as None
         """
         if mc_dropout:
             assert mc_dropout_num > 0, 'MC Dropout is enabled, but mc_droput_num is 0'
@@ -186,48 +496,79 @@ class TransformerSeq2Seq(GenieModel):
 
         assert not self.training, 'Model should be in eval() mode before generation can start.'
 
-        batch_nodrop_logits = []
-        batch_nodrop_probs = []
-        batch_nodrop_entropies = []
-        outputs = self.model(input_ids=input_ids, decoder_input_ids=predictions, attention_mask=attention_mask, return_dict=True, use_cache=False)
-        nodrop_logits = outputs.logits[:, :-1, :] # remove the last probability distribution which is for the token after EOS
-        for i in range(batch_size):
-            batch_nodrop_logits.append(nodrop_logits[i].gather(dim=1, index=truncated_predictions[i].view(-1, 1)).view(-1)[:prediction_lengths[i]])
-            probs = torch.softmax(nodrop_logits[i], dim=1)
-            batch_nodrop_probs.append(probs.gather(dim=1, index=truncated_predictions[i].view(-1, 1)).view(-1)[:prediction_lengths[i]])
-            batch_nodrop_entropies.append(-torch.sum(torch.log(probs)*probs, dim=1)[:prediction_lengths[i]])
-        
-        # activate dropout layers
-        self.train()
+        if features is None:
+            features = ConfidenceFeatures.NODROP_FIELDS + ConfidenceFeatures.DROP_FIELDS
+        # MC dropout is skipped entirely when none of its outputs are needed
+        mc_dropout = mc_dropout and any(f in features for f in ConfidenceFeatures.DROP_FIELDS)
 
-        batch_drop_logits = [[] for _ in range(batch_size)]
-        batch_drop_probs = [[] for _ in range(batch_size)]
-        for _ in range(mc_dropout_num):
+        nodrop_logits = nodrop_probs = nodrop_entropies = None
+        if any(f in features for f in ConfidenceFeatures.NODROP_FIELDS):
             outputs = self.model(input_ids=input_ids, decoder_input_ids=predictions, attention_mask=attention_mask, return_dict=True, use_cache=False)
-            drop_logits = outputs.logits[:, :-1, :] # remove the last probability distribution which is for the token after EOS
-            for i in range(batch_size):
-                batch_drop_logits[i].append((drop_logits[i].gather(dim=1, index=truncated_predictions[i].view(-1, 1)).view(-1))[:prediction_lengths[i]])
-                drop_probs = torch.softmax(drop_logits[i], dim=1).gather(dim=1, index=truncated_predictions[i].view(-1, 1)).view(-1)[:prediction_lengths[i]]
-                batch_drop_probs[i].append(drop_probs)
+            # remove the last probability distribution which is for the token after EOS
+            token_confidence = self._token_confidence(outputs.logits[:, :-1, :], truncated_predictions, entropies='nodrop_entropies' in features)
+            del outputs
+            # move everything to CPU at once, then give each prediction a copy of its own part
+            nodrop_logits, nodrop_probs = token_confidence[0].cpu(), token_confidence[1].cpu()
+            if len(token_confidence) == 3:
+                nodrop_entropies = token_confidence[2].cpu()
+
+        if mc_dropout:
+            vocab_size = self.model.get_output_embeddings().weight.shape[0]
+            # activate dropout layers
+            self.train()
+            # MC dropout samples are stacked along the batch dimension, as many in each forward pass as MAX_CONFIDENCE_LOGITS allows
+            samples_per_pass = max(1, min(mc_dropout_num, MAX_CONFIDENCE_LOGITS // (batch_size * predictions.shape[1] * vocab_size)))
+            drop_logits, drop_probs = [], []
+            for start in range(0, mc_dropout_num, samples_per_pass):
+                num_samples = min(samples_per_pass, mc_dropout_num - start)
+                outputs = self.model(input_ids=input_ids.repeat(num_samples, 1), decoder_input_ids=predictions.repeat(num_samples, 1),
+                                     attention_mask=attention_mask.repeat(num_samples, 1), return_dict=True, use_cache=False)
+                logits, probs = self._token_confidence(outputs.logits[:, :-1, :], truncated_predictions.repeat(num_samples, 1))
+                del outputs
+                drop_logits.append(logits.view(num_samples, batch_size, -1))
+                drop_probs.append(probs.view(num_samples, batch_size, -1))
+            # (mc_dropout_num, batch_size, output_length - 1)
+            drop_logits = torch.cat(drop_logits, dim=0).cpu()
+            drop_probs = torch.cat(drop_probs, dim=0).cpu()
+            # return the model back to its previous state
+            self.eval()
 
+        prediction_lengths = prediction_lengths.tolist()
+        predictions = predictions.cpu()
+        answers, answer_lengths = batch.answer.value.cpu(), batch.answer.length.tolist()
+        contexts, context_lengths = batch.context.value.cpu(), batch.context.length.tolist()
         confidence_features = []
         for i in range(batch_size):
+            length = prediction_lengths[i]
+            j = i // repetition_factor
             confidence_features.append(
-                        ConfidenceFeatures(drop_logits=batch_drop_logits[i] if mc_dropout else None,
-                                         drop_probs=batch_drop_probs[i] if mc_dropout else None,
-                                         gold_answer=batch.answer.value[i//repetition_factor][:batch.answer.length[i//repetition_factor]],
-                                         prediction=predictions[i][:prediction_lengths[i]+1],  # +1 to include EOS
-                                         nodrop_logits=batch_nodrop_logits[i][:prediction_lengths[i]],
-                                         nodrop_probs=batch_nodrop_probs[i][:prediction_lengths[i]],
-                                         nodrop_entropies=batch_nodrop_entropies[i][:prediction_lengths[i]],
-                                         context=batch.context.value[i//repetition_factor][:batch.context.length[i//repetition_factor]],
+                        ConfidenceFeatures(drop_logits=drop_logits[:, i, :length].clone() if mc_dropout else None,
+                                         drop_probs=drop_probs[:, i, :length].clone() if mc_dropout else None,
+                                         gold_answer=answers[j, :answer_lengths[j]],
+                                         prediction=predictions[i, :length+1],  # +1 to include EOS
+                                         nodrop_logits=nodrop_logits[i, :length].clone() if nodrop_logits is not None else None,
+                                         nodrop_probs=nodrop_probs[i, :length].clone() if nodrop_probs is not None else None,
+                                         nodrop_entropies=nodrop_entropies[i, :length].clone() if nodrop_entropies is not None else None,
+                                         context=contexts[j, :context_lengths[j]].clone(),
                                          ))
 
-        # return the model back to its previous state
-        self.eval()
-        
         return confidence_features
 
+    @staticmethod
+    def _token_confidence(logits, tokens, entropies=False):
+        """
+        logits: Tensor of shape (batch_size, output_length, vocab_size)
+        tokens: Tensor of shape (batch_size, output_length)
+        Returns the logit and the probability of each token, and the entropy of each distribution if `entropies` is True,
+        each of shape (batch_size, output_length)
+        """
+        log_probs = torch.log_softmax(logits, dim=-1)
+        token_logits = logits.gather(dim=-1, index=tokens.unsqueeze(-1)).squeeze(-1)
+        token_probs = log_probs.gather(dim=-1, index=tokens.unsqueeze(-1)).squeeze(-1).exp()
+        if not entropies:
+            return token_logits, token_probs
+        return token_logits, token_probs, -torch.sum(log_probs.exp() * log_probs, dim=-1)
+
     def get_length(self, prediction:Tensor):
         # skip the first token, because BOS is the same as EOS for some models
         prediction = prediction[:, 1:]
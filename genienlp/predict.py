@@ -101,6 +101,7 @@ def prepare_data_iterators(args, val_sets, numericalizer, device):
         args.val_batch_size *= len(val_sets)
     iters = []
     task_index = 0
+    cache_dir = os.path.join(args.cache, 'numericalized') if args.cache_numericalized_data else None
     for task, bs, val_set in zip(args.tasks, args.val_batch_size, val_sets):
         task_iter = []
         task_languages = args.pred_languages[task_index]
@@ -108,11 +109,13 @@ def prepare_data_iterators(args, val_sets, numericalizer, device):
             task_languages = task_languages.split('+')
             assert len(task_languages) == len(val_set)
             for index, set_ in enumerate(val_set):
-                loader, original_order = make_data_loader(set_, numericalizer, bs, device, train=False, return_original_order=True)
+                loader, original_order = make_data_loader(set_, numericalizer, bs, device, train=False, return_original_order=True,
+                                                          cache_dir=cache_dir)
                 task_iter.append((task, task_languages[index], loader, original_order))
         # single language task or no separate eval
         else:
-           loader, original_order = make_data_loader(val_set[0], numericalizer, bs, device, train=False, return_original_order=True)
+           loader, original_order = make_data_loader(val_set[0], numericalizer, bs, device, train=False, return_original_order=True,
+                                                     cache_dir=cache_dir)
            task_iter.append((task, task_languages, loader, original_order))
 
         iters.extend(task_iter)
@@ -250,6 +253,8 @@ def parse_argv(parser):
                         help='whether use exisiting cached splits or generate new ones')
     parser.add_argument('--eval_dir', type=str, required=True, help='use this directory to store eval results')
     parser.add_argument('--cache', default='.cache', type=str, help='where to save cached files')
+    parser.add_argument('--cache_numericalized_data', action='store_true',
+                        help='Cache the tokenized input data, keyed by its content and the tokenizer, for faster subsequent runs')
     parser.add_argument('--subsample', default=20000000, type=int, help='subsample the eval/test datasets (experimental)')
                         
     parser.add_argument('--pred_languages', type=str, nargs='+',
@@ -277,6 +282,10 @@ def parse_argv(parser):
     parser.add_argument("--diversity_penalty", type=float, nargs='+', default=[0.0], help='0 disables diverse beam seach')
     parser.add_argument("--no_repeat_ngram_size", type=int, nargs='+', default=[0], help='ngrams of this size cannot be repeated in the output. 0 disables it.')
     parser.add_argument('--max_output_length', default=150, type=int, help='maximum output length for generation')
+    parser.add_argument('--num_draft_tokens', default=0, type=int,
+                        help='If greater than 0, greedy decoding drafts up to this many tokens at a time by copying from the input '
+                             '(or from the n-gram table saved with --draft_ngram_table), and checks them in a single decoder pass. '
+                             'The output does not change. Only used by TransformerSeq2Seq models. 0 disables it')
 
     # These are used for confidence calibration
     parser.add_argument('--calibrator_path', type=str, default=None, help='If provided, will be used to output confidence scores for each prediction.')
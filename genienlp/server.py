@@ -30,17 +30,27 @@
 
 
 import asyncio
+import copy
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from genienlp.calibrate import ConfidenceEstimator
 import json
 import logging
+import math
+import signal
 import sys
 import os
+import threading
+import time
 from pprint import pformat
 
 import torch
 
 from . import models
 from .data_utils.example import Example, NumericalizedExamples
+from .data_utils.iterator import LengthSortedIterator
+from .server_stats import ServerStats
+from .tasks.generic_dataset import input_then_output_len, input_tokens_fn
 from .tasks.registry import get_tasks
 from .util import set_seed, init_devices, load_config_json, log_model_size
 from .validate import generate_with_model
@@ -48,136 +58,690 @@ from .validate import generate_with_model
 logger = logging.getLogger(__name__)
 
 
-class Server:
-    def __init__(self, args, numericalizer, model, device, confidence_estimator):
+class PredictionCache:
+    """
+    LRU cache of (predictions, score) tuples, with a maximum number of entries.
+    Entries older than `ttl` seconds are treated as missing; a `ttl` of 0 means entries never expire.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # the cache is used both from the event loop and from the inference thread
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl > 0 and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return dict(size=len(self._entries), hits=self.hits, misses=self.misses)
+
+
+class BatchScheduler:
+    """
+    Collects the examples of all pending requests, from all connections, in a single queue and decodes them together.
+    A batch is decoded as soon as it would exceed `max_batch_tokens` (counting padding),
+    or when `max_wait` seconds have passed since its first example arrived.
+    Decoding runs on the server's inference thread, so the event loop keeps serving connections in the meantime.
+    At most `max_queue_size` examples can be waiting; requests beyond that are rejected.
+    """
+
+    def __init__(self, server, max_batch_tokens, max_wait, max_queue_size):
+        self.server = server
+        self.max_batch_tokens = max_batch_tokens
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+        self._queue = asyncio.Queue()
+        # an example that did not fit in the previous batch
+        self._leftover = None
+
+    def is_full(self):
+        return self._queue.qsize() >= self.max_queue_size
+
+    async def predict(self, served_model, task, features):
+        """
+        Queue numericalized examples for decoding with `served_model`.
+        Returns a list of (predictions, score) tuples, in the same order as `features`.
+        Raises asyncio.QueueFull if the queue cannot take all the examples
+        """
+        loop = asyncio.get_event_loop()
+        # a request larger than the whole queue is only accepted when the queue is empty
+        if self._queue.qsize() > 0 and self._queue.qsize() + len(features) > self.max_queue_size:
+            raise asyncio.QueueFull()
+        futures = []
+        for feature in features:
+            future = loop.create_future()
+            self._queue.put_nowait((served_model, task, feature, future, time.perf_counter()))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def _next_item(self, deadline):
+        loop = asyncio.get_event_loop()
+        try:
+            # examples that are already queued are always added to the batch, even after the deadline
+            return self._queue.get_nowait()
+        except asyncio.QueueEmpty:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                return None
+            try:
+                return await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            if self._leftover is not None:
+                item = self._leftover
+                self._leftover = None
+            else:
+                item = await self._queue.get()
+            batch = [item]
+            max_length = item[2].context.length
+            deadline = loop.time() + self.max_wait
+
+            while True:
+                item = await self._next_item(deadline)
+                if item is None:
+                    break
+                new_max_length = max(max_length, item[2].context.length)
+                if new_max_length * (len(batch) + 1) > self.max_batch_tokens:
+                    self._leftover = item
+                    break
+                batch.append(item)
+                max_length = new_max_length
+
+            await self.run_batch(batch)
+
+    async def run_batch(self, batch):
+        loop = asyncio.get_event_loop()
+        # examples of different models or tasks are decoded or postprocessed differently, so we decode each separately
+        groups = dict()
+        now = time.perf_counter()
+        for served_model, task, feature, future, enqueued in batch:
+            self.server.stats.stage_latency.observe(now - enqueued, 'queue')
+            key = (served_model.name, task.name)
+            if key not in groups:
+                groups[key] = (served_model, task, [], [])
+            groups[key][2].append(feature)
+            groups[key][3].append(future)
+
+        for served_model, task, features, futures in groups.values():
+            try:
+                results = await loop.run_in_executor(self.server.executor, served_model.generate, task, features, self.server.stats)
+            except Exception as e:
+                logger.exception('Failed to decode a batch of %d examples', len(features))
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class ServedModel:
+    """
+    A model loaded by the server, together with everything that depends on it:
+    its own copy of the arguments (read from the model's config.json), numericalizer, calibrator and tasks.
+    """
+
+    def __init__(self, name, args, model, device, confidence_estimator):
+        self.name = name
         self.args = args
         self.device = device
-        self.numericalizer = numericalizer
         self.model = model
+        self.numericalizer = model.numericalizer
         self.confidence_estimator = confidence_estimator
 
         self._cached_tasks = dict()
 
-    def numericalize_examples(self, ex):
-        all_features = NumericalizedExamples.from_examples(ex, self.numericalizer)
-        # make a single batch with all examples
-        return NumericalizedExamples.collate_batches(all_features, self.numericalizer, device=self.device)
+        # everything other than the input that affects the predictions is part of the cache key
+        hyperparameters = [getattr(args, name) for name in ('max_output_length', 'num_outputs', 'temperature', 'top_k', 'top_p',
+                                                            'repetition_penalty', 'num_beams', 'num_beam_groups',
+                                                            'diversity_penalty', 'no_repeat_ngram_size')]
+        self.cache_key_suffix = (args.best_checkpoint,) + tuple(tuple(h) if isinstance(h, list) else h for h in hyperparameters)
 
-    def handle_request(self, line):
-        if isinstance(line, dict):
-            request = line
-        else:
-            request = json.loads(line)
+    def memory_size(self):
+        """
+        Number of bytes used by the parameters and buffers of the model
+        """
+        return sum(t.numel() * t.element_size() for t in list(self.model.parameters()) + list(self.model.buffers()))
 
-        task_name = request['task'] if 'task' in request else 'generic'
+    def get_task(self, task_name):
         if task_name in self._cached_tasks:
             task = self._cached_tasks[task_name]
         else:
             task = list(get_tasks([task_name], self.args).values())[0]
             self._cached_tasks[task_name] = task
+        return task
+
+    def numericalize(self, task, examples, stats):
+        with stats.time('numericalize'):
+            # this is a no-op unless preprocessing found new special tokens; it runs on the inference thread,
+            # so a batch never sees the embeddings in the middle of a resize
+            self.model.add_new_vocab_from_data([task])
+            return NumericalizedExamples.from_examples(examples, self.numericalizer)
+
+    def _collate(self, features, stats):
+        with stats.time('collate'):
+            batch = NumericalizedExamples.collate_batches(features, self.numericalizer, device=self.device)
+        stats.observe_batch(len(features), len(features) * max(input_tokens_fn(f) for f in features))
+        return batch
+
+    def generate(self, task, features, stats):
+        """
+        Decodes a list of numericalized examples, split into length-sorted batches of at most `val_batch_size` tokens.
+        Returns a list of (predictions, score) tuples, in the same order as `features`; score is None if there is no confidence estimator
+        """
+        # an example longer than the budget gets a batch of its own, instead of being skipped
+        sampler = LengthSortedIterator(features, batch_size=self.args.val_batch_size[0], sort=True, shuffle_and_repeat=False,
+                                       sort_key_fn=input_then_output_len, batch_size_fn=input_tokens_fn, keep_large_examples=True)
+        batches = (self._collate([sampler.data_source[i] for i in batch], stats) for batch in sampler)
+        output = generate_with_model(self.model, batches, self.numericalizer, task, self.args,
+                                     output_predictions_only=True,
+                                     original_order=sampler.original_order,
+                                     confidence_estimator=self.confidence_estimator,
+                                     timer=stats)
+        if self.confidence_estimator is not None:
+            scores = [float(s) for s in output.confidence_scores]
+        else:
+            scores = [None] * len(output.predictions)
+        return list(zip(output.predictions, scores))
+
+    def _postprocess(self, task, batch, generated):
+        predictions = self.numericalizer.reverse(generated)
+        return [task.postprocess_prediction(example_id, p) for example_id, p in zip(batch.example_id, predictions)]
+
+    def stream(self, task, features, every, stats):
+        """
+        Decodes a single numericalized example one token at a time, with the first set of generation hyperparameters.
+        Yields ('partial', prediction so far) every `every` tokens, and finally ('final', (predictions, score))
+        """
+        args = self.args
+        if args.num_beams[0] > 1 or args.num_outputs[0] > 1:
+            raise ValueError('Streaming is only supported for models that use greedy decoding or sampling with a single output')
+        batch = self._collate(features, stats)
+        temperature = args.temperature[0]
+        generated = None
+        for step, generated in enumerate(self.model.generate_stream(batch,
+                                                                    max_output_length=args.max_output_length,
+                                                                    temperature=temperature if temperature > 0 else 1.0,
+                                                                    repetition_penalty=args.repetition_penalty[0],
+                                                                    top_k=args.top_k[0],
+                                                                    top_p=args.top_p[0],
+                                                                    no_repeat_ngram_size=args.no_repeat_ngram_size[0],
+                                                                    do_sample=temperature != 0)):
+            if (step + 1) % every == 0:
+                yield 'partial', self._postprocess(task, batch, generated)[0]
+
+        with stats.time('postprocess'):
+            prediction = self._postprocess(task, batch, generated)[0]
+        score = None
+        if self.confidence_estimator is not None:
+            with stats.time('calibrate'):
+                confidence_features = self.model.confidence_features(batch=batch, predictions=generated,
+                                                                     mc_dropout=args.mc_dropout, mc_dropout_num=args.mc_dropout_num,
+                                                                     features=self.confidence_estimator.required_features())
+                score = float(self.confidence_estimator.estimate([[f] for f in confidence_features])[0])
+        yield 'final', ([prediction], score)
+
+
+class ModelRegistry:
+    """
+    The models served by one server, one per `--path` directory, addressed by the name of the directory.
+    Models are loaded the first time they are used; when the models in memory take more than `--max_model_memory`,
+    the least recently used ones are unloaded (they will be loaded again when needed).
+    The first model is the default, used for requests that do not specify a model.
+    """
+
+    def __init__(self, args, device):
+        self.args = args
+        self.device = device
+        self.paths = OrderedDict()
+        calibrator_paths = args.calibrator_path if args.calibrator_path is not None else [None] * len(args.path)
+        if len(calibrator_paths) != len(args.path):
+            raise ValueError('--calibrator_path must have one value for each --path')
+        for path, calibrator_path in zip(args.path, calibrator_paths):
+            name = os.path.basename(os.path.normpath(path))
+            if name in self.paths:
+                raise ValueError(f'Multiple models are named {name}, model directories must have different names')
+            self.paths[name] = (path, calibrator_path)
+        self.default_name = next(iter(self.paths))
+        self._loaded = OrderedDict()
+
+    def get(self, name=None):
+        if name is None:
+            name = self.default_name
+        if name in self._loaded:
+            self._loaded.move_to_end(name)
+            return self._loaded[name]
+        if name not in self.paths:
+            raise ValueError(f'Unknown model {name}')
+
+        served_model = load_model(self.args, *self.paths[name], self.device, name=name)
+        self._loaded[name] = served_model
+        self._evict()
+        return served_model
+
+    def loaded(self):
+        """
+        Returns the names of the models in memory, from the least to the most recently used
+        """
+        return list(self._loaded)
+
+    def _evict(self):
+        if self.args.max_model_memory <= 0:
+            return
+        max_bytes = self.args.max_model_memory * 2**30
+        # never unload the model that was just loaded
+        while len(self._loaded) > 1 and sum(m.memory_size() for m in self._loaded.values()) > max_bytes:
+            name, _ = self._loaded.popitem(last=False)
+            logger.info('Unloading model %s', name)
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+
+class Server:
+    def __init__(self, args, registry, worker_index=0):
+        self.args = args
+        self.registry = registry
+        self.worker_index = worker_index
+        self.stats = ServerStats()
+
+        self.cache = None
+        if args.cache_size > 0:
+            self.cache = PredictionCache(args.cache_size, args.cache_ttl)
+
+        # all the work that touches the models runs on a single thread, off the event loop
+        # gradients are disabled per thread, so the inference thread disables them for itself
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference',
+                                           initializer=torch.set_grad_enabled, initargs=(False,))
+        self.scheduler = None
+
+    def parse_request(self, request):
+        """
+        Returns the model, the task and the preprocessed examples of a request
+        """
+        served_model = self.registry.get(request.get('model'))
+        task = served_model.get_task(request['task'] if 'task' in request else 'generic')
 
         if 'instances' in request:
-            examples = []
             # request['instances'] is an array of {context, question, answer, example_id}
-            for instance in request['instances']:
+            instances = request['instances']
+        else:
+            instances = [dict(example_id=request['id'], context=request['context'], question=request['question'])]
+
+        examples = []
+        with self.stats.time('preprocess'):
+            for instance in instances:
                 example_id, context, question, answer = instance.get('example_id', ''), instance['context'], instance['question'], instance.get('answer', '')
                 if not context:
                     context = task.default_context
                 if not question:
                     question = task.default_question
 
-                ex = Example.from_raw(str(example_id), context, question, answer, preprocess=task.preprocess_field, lower=self.args.lower)
+                ex = Example.from_raw(str(example_id), context, question, answer, preprocess=task.preprocess_field, lower=served_model.args.lower)
                 examples.append(ex)
 
-            self.model.add_new_vocab_from_data([task])
-            batch = self.numericalize_examples(examples)
-            # it is a single batch, so wrap it in []
-            if self.args.calibrator_path is not None:
-                output = generate_with_model(self.model, [batch], self.numericalizer, task, self.args,
-                                                  output_predictions_only=True,
-                                                  confidence_estimator=self.confidence_estimator)
-
-                response = json.dumps({ 'id': request['id'], 'instances': [{ 'answer': p[0], 'score': float(s)} for (p, s) in zip(output.predictions, output.confidence_scores)]})
-            else:
-                output = generate_with_model(self.model, [batch], self.numericalizer, task, self.args,
-                                                  output_predictions_only=True)
+        return served_model, task, examples
+
+    def _cache_key(self, served_model, task, example):
+        return (task.name, example.context, example.question) + served_model.cache_key_suffix
+
+    def lookup_cache(self, served_model, task, examples):
+        """
+        Returns a list with the cached result of each example (None if it is not cached),
+        and the indices of the examples that need to be decoded
+        """
+        if self.cache is None:
+            return [None] * len(examples), list(range(len(examples)))
+        results = [self.cache.get(self._cache_key(served_model, task, ex)) for ex in examples]
+        return results, [i for i, result in enumerate(results) if result is None]
 
-                response = json.dumps({ 'id': request['id'], 'instances': [{ 'answer': p[0]} for p in output.predictions]})
-            return response + '\n'
+    def update_cache(self, served_model, task, examples, results):
+        if self.cache is None:
+            return
+        for ex, result in zip(examples, results):
+            self.cache.put(self._cache_key(served_model, task, ex), result)
+
+    def format_response(self, request, results):
+        if 'instances' in request:
+            instances = []
+            for predictions, score in results:
+                instance = {'answer': predictions[0]}
+                if score is not None:
+                    instance['score'] = score
+                instances.append(instance)
+            response = {'id': request['id'], 'instances': instances}
         else:
-            context = request['context']
-            if not context:
-                context = task.default_context
-            question = request['question']
-            if not question:
-                question = task.default_question
-            answer = ''
+            predictions, score = results[0]
+            response = dict(id=request['id'], answer=predictions[0])
+            if score is not None:
+                response['score'] = score
+        return json.dumps(response) + '\n'
+
+    def _counters(self):
+        if self.cache is None:
+            return None
+        cache_stats = self.cache.stats()
+        return {
+            'genienlp_cache_hits_total': ('Number of examples answered from the prediction cache', cache_stats['hits']),
+            'genienlp_cache_misses_total': ('Number of examples that were not in the prediction cache', cache_stats['misses']),
+        }
+
+    def stats_response(self, request):
+        stats = self.stats.to_dict()
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        stats['loaded_models'] = self.registry.loaded()
+        return json.dumps(dict(id=request.get('id'), stats=stats)) + '\n'
+
+    def stream_request(self, request):
+        """
+        Handles a request with `stream` set, which must have a single example.
+        Yields a response with the `partial` answer every `stream_every` generated tokens (default 1), then the full response
+        """
+        served_model, task, examples = self.parse_request(request)
+        if 'instances' in request:
+            raise ValueError('Streaming is only supported for requests with a single example')
+        results, missing = self.lookup_cache(served_model, task, examples)
+        if missing:
+            features = served_model.numericalize(task, examples, self.stats)
+            for kind, value in served_model.stream(task, features, max(1, int(request.get('stream_every', 1))), self.stats):
+                if kind == 'partial':
+                    yield json.dumps(dict(id=request['id'], partial=value)) + '\n'
+                else:
+                    results = [value]
+                    self.update_cache(served_model, task, examples, results)
+        yield self.format_response(request, results)
 
-            ex = Example.from_raw(str(request['id']), context, question, answer, preprocess=task.preprocess_field, lower=self.args.lower)
+    def handle_request(self, line):
+        start = time.perf_counter()
+        if isinstance(line, dict):
+            request = line
+        else:
+            request = json.loads(line)
+        if request.get('type') == 'stats':
+            return self.stats_response(request)
+
+        served_model, task, examples = self.parse_request(request)
+        results, missing = self.lookup_cache(served_model, task, examples)
+        if missing:
+            missing_examples = [examples[i] for i in missing]
+            missing_results = served_model.generate(task, served_model.numericalize(task, missing_examples, self.stats), self.stats)
+            self.update_cache(served_model, task, missing_examples, missing_results)
+            for i, result in zip(missing, missing_results):
+                results[i] = result
+        response = self.format_response(request, results)
+        self.stats.request_latency.observe(time.perf_counter() - start)
+        return response
+
+    async def _stream_request_async(self, request, write):
+        # streams are decoded on the inference thread, one token at a time, and not batched with other requests
+        loop = asyncio.get_event_loop()
+        responses = asyncio.Queue()
+        # set if the client goes away, to stop decoding early
+        stopped = threading.Event()
 
-            self.model.add_new_vocab_from_data([task])
-            batch = self.numericalize_examples([ex])
-            if self.args.calibrator_path is not None:
-                output = generate_with_model(self.model, [batch], self.numericalizer, task, self.args,
-                                                  output_predictions_only=True,
-                                                  confidence_estimator=self.confidence_estimator)
-                response = json.dumps(dict(id=request['id'], answer=output.predictions[0][0], score=float(output.confidence_scores[0])))
-            else:
-                output = generate_with_model(self.model, [batch], self.numericalizer, task, self.args,
-                                                  output_predictions_only=True)
-                response = json.dumps(dict(id=request['id'], answer=output.predictions[0][0]))
-            return response + '\n'
+        def run():
+            try:
+                for response in self.stream_request(request):
+                    if stopped.is_set():
+                        break
+                    loop.call_soon_threadsafe(responses.put_nowait, response)
+            except Exception as e:
+                loop.call_soon_threadsafe(responses.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(responses.put_nowait, None)
+
+        done = loop.run_in_executor(self.executor, run)
+        try:
+            while True:
+                response = await responses.get()
+                if response is None:
+                    break
+                if isinstance(response, Exception):
+                    raise response
+                await write(response)
+        finally:
+            stopped.set()
+            await done
+
+    async def handle_request_async(self, line, write):
+        """
+        Handles one request, and calls the `write` coroutine with each response (more than one if the request is streamed)
+        """
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        request = None
+        try:
+            request = json.loads(line)
+            if request.get('type') == 'stats':
+                await write(self.stats_response(request))
+                return
+            if self.scheduler.is_full():
+                raise asyncio.QueueFull()
+            if request.get('stream'):
+                await self._stream_request_async(request, write)
+                self.stats.request_latency.observe(time.perf_counter() - start)
+                return
+            served_model, task, examples = await loop.run_in_executor(self.executor, self.parse_request, request)
+            results, missing = self.lookup_cache(served_model, task, examples)
+            if missing:
+                missing_examples = [examples[i] for i in missing]
+                features = await loop.run_in_executor(self.executor, served_model.numericalize, task, missing_examples, self.stats)
+                missing_results = await self.scheduler.predict(served_model, task, features)
+                self.update_cache(served_model, task, missing_examples, missing_results)
+                for i, result in zip(missing, missing_results):
+                    results[i] = result
+            response = self.format_response(request, results)
+            self.stats.request_latency.observe(time.perf_counter() - start)
+            await write(response)
+            return
+        except asyncio.QueueFull:
+            error = 'server overloaded'
+        except IOError:
+            raise
+        except Exception as e:
+            logger.exception('Failed to handle request')
+            error = str(e)
+        request_id = request.get('id') if isinstance(request, dict) else None
+        await write(json.dumps(dict(id=request_id, error=error)) + '\n')
+
+    async def _respond(self, line, client_writer, write_lock, pending):
+        async def write(response):
+            async with write_lock:
+                # responses are written as soon as they are ready, clients match them to requests by id
+                client_writer.write(response.encode('utf-8'))
+                await client_writer.drain()
+
+        try:
+            await self.handle_request_async(line, write)
+        except IOError:
+            pass
+        finally:
+            pending.release()
 
     async def handle_client(self, client_reader, client_writer):
+        # clients can pipeline many requests on the same connection; we stop reading from a connection that
+        # has too many requests in flight, which pushes back on that client without blocking the others
+        pending = asyncio.Semaphore(self.args.max_queue_size)
+        write_lock = asyncio.Lock()
+        tasks = set()
         try:
             line = await client_reader.readline()
             while line:
-                client_writer.write(self.handle_request(line).encode('utf-8'))
+                await pending.acquire()
+                task = asyncio.ensure_future(self._respond(line, client_writer, write_lock, pending))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
                 line = await client_reader.readline()
+            if tasks:
+                await asyncio.wait(tasks)
 
         except IOError:
             logger.info('Connection to client_reader closed')
+        finally:
+            for task in tasks:
+                task.cancel()
             try:
                 client_writer.close()
             except IOError:
                 pass
 
+    async def handle_metrics(self, client_reader, client_writer):
+        """
+        A minimal HTTP endpoint that returns the statistics in the Prometheus text format, whatever the request
+        """
+        try:
+            line = await client_reader.readline()
+            while line and line not in (b'\r\n', b'\n'):
+                line = await client_reader.readline()
+            body = self.stats.to_prometheus(self._counters()).encode('utf-8')
+            client_writer.write(b'HTTP/1.0 200 OK\r\n'
+                                b'Content-Type: text/plain; version=0.0.4\r\n' +
+                                f'Content-Length: {len(body)}\r\n\r\n'.encode('utf-8') + body)
+            await client_writer.drain()
+        except IOError:
+            pass
+        finally:
+            client_writer.close()
+
+    def _make_scheduler(self, max_queue_size):
+        # the default model decides the size of the batches; each model then splits them according to its own val_batch_size
+        return BatchScheduler(self, max_batch_tokens=self.registry.get().args.val_batch_size[0],
+                              max_wait=self.args.max_batch_wait / 1000,
+                              max_queue_size=max_queue_size)
+
     def _run_tcp(self):
         loop = asyncio.get_event_loop()
-        server = loop.run_until_complete(asyncio.start_server(self.handle_client, port=self.args.port))
+        self.scheduler = self._make_scheduler(self.args.max_queue_size)
+        scheduler_task = loop.create_task(self.scheduler.run())
+        # with multiple workers, each worker listens on the same port and the kernel balances connections between them
+        server = loop.run_until_complete(asyncio.start_server(self.handle_client, port=self.args.port,
+                                                              reuse_port=self.args.workers > 1))
+        metrics_server = None
+        if self.args.metrics_port is not None:
+            # each worker exports its own statistics on its own port
+            metrics_server = loop.run_until_complete(asyncio.start_server(self.handle_metrics,
+                                                                          port=self.args.metrics_port + self.worker_index))
         try:
             loop.run_forever()
         except KeyboardInterrupt:
             pass
         server.close()
+        scheduler_task.cancel()
         loop.run_until_complete(server.wait_closed())
+        if metrics_server is not None:
+            metrics_server.close()
+            loop.run_until_complete(metrics_server.wait_closed())
         loop.close()
+        self.executor.shutdown()
 
-    def _run_stdin(self):
+    async def _handle_stdin_request(self, line, responses):
         try:
+            await self.handle_request_async(line, responses.put)
+        finally:
+            responses.put_nowait(None)
+
+    async def _write_stdout(self, outputs):
+        """
+        Writes the responses of each request in input order. Output is flushed whenever we have to wait for the next response
+        """
+        while True:
+            if outputs.empty():
+                sys.stdout.flush()
+            responses = await outputs.get()
+            if responses is None:
+                break
             while True:
-                line = sys.stdin.readline()
-                if not line:
+                if responses.empty():
+                    sys.stdout.flush()
+                response = await responses.get()
+                if response is None:
                     break
-                sys.stdout.write(self.handle_request(line))
-                sys.stdout.flush()
+                sys.stdout.write(response)
+        sys.stdout.flush()
+
+    async def _serve_stdin(self):
+        loop = asyncio.get_event_loop()
+        lines = asyncio.Queue(maxsize=self.args.max_queue_size)
+
+        # reading stdin blocks, so it is done on a separate thread that reads ahead as far as `lines` allows
+        def read():
+            for line in sys.stdin:
+                asyncio.run_coroutine_threadsafe(lines.put(line), loop).result()
+            asyncio.run_coroutine_threadsafe(lines.put(None), loop).result()
+        threading.Thread(target=read, name='stdin', daemon=True).start()
+
+        # the responses of each request, in input order; at most `max_queue_size` requests are in flight
+        outputs = asyncio.Queue(maxsize=self.args.max_queue_size)
+        writer = asyncio.ensure_future(self._write_stdout(outputs))
+        while True:
+            line = await lines.get()
+            if line is None:
+                break
+            responses = asyncio.Queue()
+            await outputs.put(responses)
+            asyncio.ensure_future(self._handle_stdin_request(line, responses))
+        await outputs.put(None)
+        await writer
+
+    def _run_stdin(self):
+        loop = asyncio.get_event_loop()
+        # lines are read ahead and go through the same scheduler as TCP requests, so lines that are already available
+        # are decoded together; nobody would retry a rejected request, so the number of requests in flight is bounded instead
+        self.scheduler = self._make_scheduler(math.inf)
+        scheduler_task = loop.create_task(self.scheduler.run())
+        try:
+            loop.run_until_complete(self._serve_stdin())
         except KeyboardInterrupt:
             pass
+        scheduler_task.cancel()
+        loop.close()
+        self.executor.shutdown()
 
     def run(self):
-        log_model_size(logger, self.model, self.args.model)
-        self.model.to(self.device)
-
-        self.model.eval()
         with torch.no_grad():
             if self.args.stdin:
                 self._run_stdin()
             else:
                 self._run_tcp()
 
+        if self.cache is not None:
+            logger.info('Prediction cache: %s', self.cache.stats())
+
 
 def parse_argv(parser):
-    parser.add_argument('--path', type=str, required=True)
+    parser.add_argument('--path', type=str, nargs='+', required=True,
+                        help='Directories of the models to serve. Requests choose a model with the `model` field, set to the name of the directory; '
+                             'requests without it use the first model')
     parser.add_argument('--devices', default=[0], nargs='+', type=int,
                         help='a list of devices that can be used (multi-gpu currently WIP)')
     parser.add_argument('--seed', default=123, type=int, help='Random seed.')
@@ -188,20 +752,40 @@ def parse_argv(parser):
     parser.add_argument('--stdin', action='store_true', help='Interact on stdin/stdout instead of TCP')
     parser.add_argument('--locale', default='en', help='locale tag of the language to parse')
     parser.add_argument('--inference_name', default='nlp', help='name used by kfserving inference service, alphanumeric only')
+    parser.add_argument('--val_batch_size', nargs='+', default=None, type=int,
+                        help='Maximum number of tokens (including padding) in each batch. Defaults to the value used during training')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of worker processes, which share the weights of the model and split the CPU cores (TCP mode on CPU only)')
+    parser.add_argument('--num_draft_tokens', default=0, type=int,
+                        help='If greater than 0, greedy decoding drafts up to this many tokens at a time by copying from the input '
+                             '(or from the n-gram table saved with --draft_ngram_table), and checks them in a single decoder pass. '
+                             'The output does not change. Only used by TransformerSeq2Seq models. 0 disables it')
+    parser.add_argument('--max_batch_wait', default=5, type=float,
+                        help='Maximum time (in milliseconds) to wait for more requests before decoding a batch')
+    parser.add_argument('--max_queue_size', default=1000, type=int,
+                        help='Maximum number of examples waiting to be decoded; further requests are rejected until the queue drains. '
+                             'In stdin mode, maximum number of requests read ahead of the answers')
+    parser.add_argument('--metrics_port', default=None, type=int,
+                        help='If provided, export latency and batch statistics in the Prometheus format over HTTP on this port (TCP mode only). '
+                             'With multiple workers, worker i uses port `--metrics_port` + i')
+    parser.add_argument('--max_model_memory', default=0, type=float,
+                        help='Maximum memory (in GiB) taken by the parameters of loaded models, least recently used models are unloaded beyond that. 0 means no limit')
+    parser.add_argument('--cache_size', default=0, type=int,
+                        help='Maximum number of predictions to keep in an in-memory cache, to answer repeated inputs without decoding them. 0 disables the cache')
+    parser.add_argument('--cache_ttl', default=0, type=float,
+                        help='Time (in seconds) after which cached predictions expire. 0 means they never expire')
 
     # for confidence estimation:
-    parser.add_argument('--calibrator_path', type=str, default=None,
-                        help='If provided, will be used to output confidence scores for each prediction. Defaults to `--path`/calibrator.pkl')
-
-def init(args):
+    parser.add_argument('--calibrator_path', type=str, nargs='+', default=None,
+                        help='If provided, will be used to output confidence scores for each prediction, one for each `--path`. Defaults to `--path`/calibrator.pkl')
+
+def load_model(args, path, calibrator_path, device, name):
+    # each model gets its own copy of the arguments, completed with the values in its config.json
+    args = copy.copy(args)
+    args.path = path
+    args.calibrator_path = calibrator_path
     load_config_json(args)
-    set_seed(args)
-
-    logger.info(f'Arguments:\n{pformat(vars(args))}')
-    logger.info(f'Loading from {args.best_checkpoint}')
-
-    devices = init_devices(args)
-    device = devices[0] # server only runs on a single device
+    logger.info(f'Loading model {name} from {args.best_checkpoint}')
 
     Model = getattr(models, args.model)
     model, _ = Model.from_pretrained(args.path,
@@ -212,7 +796,7 @@ def init(args):
 
     model.set_decoder_start_token_id(args.locale)
 
-    
+    log_model_size(logger, model, args.model)
     model.to(device)
     model.eval()
 
@@ -228,10 +812,78 @@ def init(args):
         logger.info('Loading confidence estimator "%s" from %s', confidence_estimator.name, args.calibrator_path)
         args.mc_dropout = confidence_estimator.mc_dropout
         args.mc_dropout_num = confidence_estimator.mc_dropout_num
-    return model, device, confidence_estimator
+    return ServedModel(name, args, model, device, confidence_estimator)
+
+
+def init(args):
+    set_seed(args)
+
+    logger.info(f'Arguments:\n{pformat(vars(args))}')
+
+    devices = init_devices(args)
+    device = devices[0] # server only runs on a single device
+
+    if args.workers > 1:
+        if args.stdin:
+            raise ValueError('Multiple workers are only supported in TCP mode, not with --stdin')
+        if device.type != 'cpu':
+            raise ValueError('Multiple workers are only supported when running on CPU')
+        # each worker gets its share of the cores, so they do not compete for them
+        torch.set_num_threads(max(1, os.cpu_count() // args.workers))
+
+    registry = ModelRegistry(args, device)
+    # load the default model right away, other models are loaded when they are first used
+    registry.get()
+    return registry
+
+
+def run_workers(args, registry):
+    """
+    Forks `args.workers` processes that serve on the same port.
+    The workers inherit the models loaded so far from fork(), which shares their memory copy-on-write; inference never
+    writes to the parameters, so they are not copied. (share_memory() is not needed for that: it only matters for tensors
+    sent through torch.multiprocessing, and it would copy every parameter once more before forking.)
+    """
+    pids = []
+    for worker_index in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                torch.set_num_threads(max(1, os.cpu_count() // args.workers))
+                Server(args, registry, worker_index=worker_index).run()
+            except Exception:
+                logger.exception('Worker %d failed', os.getpid())
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        pids.append(pid)
+    logger.info('Started %d workers', len(pids))
+
+    def terminate(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, terminate)
+
+    for pid in pids:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except KeyboardInterrupt:
+                # the workers receive the interrupt as well, wait for them to exit
+                continue
+            except ChildProcessError:
+                break
 
 
 def main(args):
-    model, device, confidence_estimator = init(args)
-    server = Server(args, model.numericalizer, model, device, confidence_estimator)
-    server.run()
+    registry = init(args)
+    if args.workers > 1:
+        run_workers(args, registry)
+    else:
+        server = Server(args, registry)
+        server.run()
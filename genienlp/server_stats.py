@@ -0,0 +1,138 @@
+#
+# Copyright (c) 2021 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+BATCH_TOKENS_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+
+
+class Histogram:
+    """
+    A histogram in the style of Prometheus, optionally with one label.
+    Values are counted in the first bucket whose upper bound is greater or equal to them.
+    """
+
+    def __init__(self, name, help, buckets, label=None):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._lock = threading.Lock()
+        # label value -> (counts of each bucket plus one for +Inf, sum of the values)
+        self._series = dict()
+
+    def observe(self, value, label_value=None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if label_value not in self._series:
+                self._series[label_value] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = self._series[label_value]
+            counts[index] += 1
+            total[0] += value
+
+    def _snapshot(self):
+        with self._lock:
+            return [(label_value, list(counts), total[0]) for label_value, (counts, total) in sorted(self._series.items(), key=lambda x: str(x[0]))]
+
+    def to_prometheus(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label_value, counts, total in self._snapshot():
+            labels = f'{self.label}="{label_value}",' if self.label is not None else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            labels = '{' + labels[:-1] + '}' if labels else ''
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+    def to_dict(self):
+        result = dict()
+        for label_value, counts, total in self._snapshot():
+            cumulative = 0
+            buckets = dict()
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            result[label_value if label_value is not None else 'all'] = dict(count=cumulative, sum=total, buckets=buckets)
+        return result
+
+
+class ServerStats:
+    """
+    Latency of each stage of serving a request, and size of the batches that are decoded.
+    Stages are timed with `with stats.time(stage): ...`, which costs about a microsecond.
+    """
+
+    def __init__(self):
+        self.stage_latency = Histogram('genienlp_stage_latency_seconds', 'Time spent in each stage of serving requests',
+                                       LATENCY_BUCKETS, label='stage')
+        self.request_latency = Histogram('genienlp_request_latency_seconds', 'Time from receiving a request to sending its response',
+                                         LATENCY_BUCKETS)
+        self.batch_size = Histogram('genienlp_batch_size_examples', 'Number of examples in each decoded batch',
+                                    BATCH_SIZE_BUCKETS)
+        self.batch_tokens = Histogram('genienlp_batch_tokens', 'Number of input tokens in each decoded batch, including padding',
+                                      BATCH_TOKENS_BUCKETS)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_latency.observe(time.perf_counter() - start, stage)
+
+    def observe_batch(self, num_examples, num_tokens):
+        self.batch_size.observe(num_examples)
+        self.batch_tokens.observe(num_tokens)
+
+    def _histograms(self):
+        return (self.request_latency, self.stage_latency, self.batch_size, self.batch_tokens)
+
+    def to_prometheus(self, counters=None):
+        """
+        Returns all statistics in the Prometheus text format.
+        `counters` is an optional dict of additional counters, from name to (help, value)
+        """
+        lines = []
+        for histogram in self._histograms():
+            lines += histogram.to_prometheus()
+        if counters is not None:
+            for name, (help, value) in counters.items():
+                lines += [f'# HELP {name} {help}', f'# TYPE {name} counter', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        return {histogram.name: histogram.to_dict() for histogram in self._histograms()}
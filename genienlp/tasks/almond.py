@@ -30,7 +30,8 @@
 import os
 import torch
 import logging
-from collections import defaultdict
+import multiprocessing
+from collections import defaultdict, deque
 
 from .base_task import BaseTask
 from .registry import register_task
@@ -44,6 +45,68 @@ from .base_dataset import Split
 
 logger = logging.getLogger(__name__)
 
+# files smaller than this are parsed in the main process, because starting the worker processes would take longer
+PARALLEL_READ_MIN_BYTES = 4 * 1024 * 1024
+# smallest byte range parsed by a worker process at once
+PARALLEL_READ_MIN_CHUNK_BYTES = 1024 * 1024
+
+
+def _lines_in_range(fp, end):
+    """
+    Yields the lines of `fp` from its current position, until the first line that starts at or after byte `end`
+    """
+    position = fp.tell()
+    while position < end:
+        line = fp.readline()
+        if not line:
+            break
+        position += len(line)
+        yield line
+
+
+def _read_lines(path, start, end, make_example, dir_name, max_examples, progress_total=None, **kwargs):
+    """
+    Parses the lines of `path` that start in the byte range [start, end), stopping after `max_examples` examples.
+    If `progress_total` is not None, shows a progress bar that expects that many examples
+    """
+    examples = []
+    if max_examples == 0:
+        return examples
+    with open(path, 'rb') as fp:
+        if start > 0:
+            # skip the line that started in the previous range, unless that range ends exactly at its newline
+            fp.seek(start - 1)
+            fp.readline()
+        lines = _lines_in_range(fp, end)
+        if progress_total is not None:
+            lines = progress_bar(lines, total=progress_total, desc="Reading Dataset")
+        for line in lines:
+            parts = line.decode('utf-8').strip().split('\t')
+            examples.append(make_example(parts, dir_name, **kwargs))
+            if max_examples is not None and len(examples) >= max_examples:
+                break
+    return examples
+
+
+_worker_args = None
+
+
+def _init_read_worker(make_example, dir_name, kwargs):
+    global _worker_args
+    _worker_args = (make_example, dir_name, kwargs)
+
+
+def _read_lines_in_worker(byte_range):
+    make_example, dir_name, kwargs = _worker_args
+    path, start, end, max_examples = byte_range
+    examples = _read_lines(path, start, end, make_example, dir_name, max_examples, **kwargs)
+
+    # return the special tokens this range added to the worker's copy of the task, so they can be added to the real one
+    task = make_example.__self__
+    special_tokens = task.special_tokens
+    task.special_tokens = set()
+    return examples, special_tokens
+
 
 class AlmondDataset(CQA):
     """Obtaining dataset for Almond semantic parsing task"""
@@ -60,25 +123,52 @@ class AlmondDataset(CQA):
             logger.info(f'Loading cached data from {cache_name}')
             examples = torch.load(cache_name)
         else:
-            examples = []
-            n = 0
-            with open(path, 'r', encoding='utf-8') as fp:
-                for line in fp:
-                    n += 1
-
-            max_examples = min(n, subsample) if subsample is not None else n
-            for line in progress_bar(open(path, 'r', encoding='utf-8'), total=max_examples, desc="Reading Dataset"):
-                parts = line.strip().split('\t')
-                examples.append(make_example(parts, dir_name, **kwargs))
-                if len(examples) >= max_examples:
-                    break
+            examples = self._read_examples(path, make_example, dir_name, subsample, **kwargs)
             os.makedirs(os.path.dirname(cache_name), exist_ok=True)
             if cache_input_data:
                 logger.info(f'Caching data to {cache_name}')
                 torch.save(examples, cache_name)
 
         super().__init__(examples, **kwargs)
-        
+
+    @staticmethod
+    def _read_examples(path, make_example, dir_name, max_examples, **kwargs):
+        """
+        Splits the file in byte ranges and parses them in a pool of processes, keeping the order of the lines.
+        """
+        file_size = os.path.getsize(path)
+        num_processes = multiprocessing.cpu_count()
+        task = make_example.__self__
+        if file_size < PARALLEL_READ_MIN_BYTES or num_processes == 1 or not task.parallel_parsing:
+            # the lines are streamed without counting them first, so the progress bar is only shown when the number of examples is known
+            return _read_lines(path, 0, file_size, make_example, dir_name, max_examples, progress_total=max_examples, **kwargs)
+
+        # a few ranges per process, so that processes that get short lines do not wait for the others at the end
+        range_size = max(file_size // (4 * num_processes), PARALLEL_READ_MIN_CHUNK_BYTES)
+        byte_ranges = [(path, start, min(start + range_size, file_size), max_examples) for start in range(0, file_size, range_size)]
+
+        examples = []
+        with multiprocessing.Pool(num_processes, initializer=_init_read_worker, initargs=(make_example, dir_name, kwargs)) as pool:
+            # only a couple of ranges per process are submitted ahead of the one being collected, so that the rest of the file
+            # is not parsed once `max_examples` examples are read
+            max_pending = 2 * num_processes
+            results = deque(pool.apply_async(_read_lines_in_worker, (byte_range,)) for byte_range in byte_ranges[:max_pending])
+            for i, byte_range in enumerate(progress_bar(byte_ranges, desc="Reading Dataset")):
+                range_examples, special_tokens = results.popleft().get()
+                if i + max_pending < len(byte_ranges):
+                    results.append(pool.apply_async(_read_lines_in_worker, (byte_ranges[i + max_pending],)))
+                if max_examples is not None and len(examples) + len(range_examples) > max_examples:
+                    # parse the part of this range that is kept again, so the task only gets the special tokens of those examples
+                    _path, start, end, _max_examples = byte_range
+                    examples += _read_lines(path, start, end, make_example, dir_name, max_examples - len(examples), **kwargs)
+                    break
+                task.special_tokens.update(special_tokens)
+                examples += range_examples
+                if max_examples is not None and len(examples) == max_examples:
+                    # stop early, the remaining ranges are not needed
+                    break
+        return examples
+
 
     @classmethod
     def return_splits(cls, path, train='train', validation='eval', test='test', **kwargs):
@@ -114,6 +204,9 @@ class BaseAlmondTask(BaseTask):
     """Base class for the Almond semantic parsing task
         i.e. natural language to formal language (ThingTalk) mapping"""
 
+    # whether the lines of a dataset can be parsed independently, in separate processes
+    parallel_parsing = True
+
     def __init__(self, name, args):
         super().__init__(name, args)
         self._almond_has_multiple_programs = args.almond_has_multiple_programs
@@ -275,6 +368,9 @@ class Paraphrase(NaturalSeq2Seq):
     Should only be used at prediction time.
     """
 
+    # example ids are deduplicated against the preceding lines, and reverse_maps must be filled in this process
+    parallel_parsing = False
+
     def __init__(self, name, args):
         super().__init__(name, args)
         self.reverse_maps = {}
@@ -211,7 +211,7 @@ def do_validate(iteration, args, model, numericalizer, val_iters, *,
 
 
 def maybe_save(iteration, model, opt, deca_score, best_decascore, *,
-               saver, logger, train_task, round_progress, task_progress, timestamp, log_dir, model_parallel):
+               saver, logger, train_task, round_progress, task_progress, timestamp, log_dir, model_parallel, sampler_states=None):
     should_save_best = False
     if deca_score is not None and (best_decascore is None or best_decascore < deca_score):
         best_decascore = deca_score
@@ -233,6 +233,8 @@ def maybe_save(iteration, model, opt, deca_score, best_decascore, *,
     }
     save_opt_state_dict = opt.state_dict()
     save_opt_state_dict.update({'start_iteration': iteration})
+    if sampler_states is not None:
+        save_opt_state_dict.update({'sampler_states': sampler_states})
 
     saver.save(save_model_state_dict, save_opt_state_dict, global_step=iteration)
     if should_save_best:
@@ -289,7 +291,7 @@ def get_next_batch(train_iter, aux_iters, *, task, task_idx, task_fraction, use_
 
 def train(args, devices, model, opt, lr_scheduler, train_sets, train_iterations, numericalizer, *,
           log_every, val_every, save_every, rounds, val_sets, aux_sets, writer, logger, log_prefix,
-          start_iteration=1, rnd=1, best_decascore, use_curriculum):
+          start_iteration=1, rnd=1, best_decascore, use_curriculum, sampler_states=None):
     """main training function"""
     local_loss, num_examples, len_contexts, len_answers, iteration = 0, 0, 0, 0, 1
 
@@ -309,16 +311,25 @@ def train(args, devices, model, opt, lr_scheduler, train_sets, train_iterations,
 
     logger.info(f'Preparing iterators')
     main_device = devices[0]
-    train_iters = [(task, make_data_loader(x, numericalizer, tok, main_device, train=True))
-                   for task, x, tok in zip(args.train_tasks, train_sets, args.train_batch_tokens)]
-    train_iters = [(task, iter(train_iter)) for task, train_iter in train_iters]
-
-    val_iters = [(task, make_data_loader(x, numericalizer, bs, main_device, train=False))
+    cache_dir = os.path.join(args.cache, 'numericalized') if args.cache_numericalized_data else None
+    train_loaders = [make_data_loader(x, numericalizer, tok, main_device, train=True, cache_dir=cache_dir)
+                     for x, tok in zip(train_sets, args.train_batch_tokens)]
+    train_samplers = [loader.batch_sampler for loader in train_loaders]
+    # samplers that can save their position allow resuming without going through all the batches before the checkpoint
+    save_sampler_states = all(hasattr(sampler, 'state_dict') for sampler in train_samplers) and not use_curriculum
+    restored_samplers = False
+    if save_sampler_states and sampler_states is not None and len(sampler_states) == len(train_samplers):
+        for sampler, state in zip(train_samplers, sampler_states):
+            sampler.load_state_dict(state)
+        restored_samplers = True
+    train_iters = [(task, iter(loader)) for task, loader in zip(args.train_tasks, train_loaders)]
+
+    val_iters = [(task, make_data_loader(x, numericalizer, bs, main_device, train=False, cache_dir=cache_dir))
                  for task, x, bs in zip(args.val_tasks, val_sets, args.val_batch_size)]
 
     aux_iters = []
     if use_curriculum:
-        aux_iters = [(name, make_data_loader(x, numericalizer, tok, main_device, train=True))
+        aux_iters = [(name, make_data_loader(x, numericalizer, tok, main_device, train=True, cache_dir=cache_dir))
                      for name, x, tok in zip(args.train_tasks, aux_sets, args.train_batch_tokens)]
         aux_iters = [(task, iter(aux_iter)) for task, aux_iter in aux_iters]
         
@@ -344,11 +355,19 @@ def train(args, devices, model, opt, lr_scheduler, train_sets, train_iterations,
                 task_done[task] = True
                 continue
 
-            # load batches even if (args.resume == True) and we are going to skip the iteration
-            # this makes runs that are resumed have the exact same behavior as runs that are
-            # finished in one pass (given that the random seed is the same).
-            batch = get_next_batch(train_iter, aux_iters, task=task, task_idx=task_idx,
-                                   task_fraction=task_fraction, use_curriculum=use_curriculum)
+            if iteration < start_iteration and restored_samplers:
+                # the samplers were restored to the position of the checkpoint, so the skipped batches need not be loaded
+                batch = None
+            else:
+                if save_sampler_states:
+                    # when resuming, the iteration of the checkpoint is trained again, so save the state before its batch
+                    sampler_state_before_batch = train_samplers[task_idx].state_dict()
+
+                # load batches even if (args.resume == True) and we are going to skip the iteration
+                # this makes runs that are resumed have the exact same behavior as runs that are
+                # finished in one pass (given that the random seed is the same).
+                batch = get_next_batch(train_iter, aux_iters, task=task, task_idx=task_idx,
+                                       task_fraction=task_fraction, use_curriculum=use_curriculum)
 
             if iteration < start_iteration:
                 # skip this iteration (this is done to ensure iterators are at the same position when resuming)
@@ -411,10 +430,16 @@ def train(args, devices, model, opt, lr_scheduler, train_sets, train_iterations,
 
                 # saving
                 if should_save(iteration, save_every):
+                    if save_sampler_states:
+                        sampler_states = [sampler_state_before_batch if idx == task_idx else sampler.state_dict()
+                                          for idx, sampler in enumerate(train_samplers)]
+                    else:
+                        sampler_states = None
                     best_decascore = maybe_save(iteration, model, opt, deca_score, best_decascore,
                                                 saver=saver, logger=logger, train_task=task,
                                                 round_progress=round_progress, task_progress=task_progress,
-                                                timestamp=args.timestamp, log_dir=args.log_dir, model_parallel=args.model_parallel)
+                                                timestamp=args.timestamp, log_dir=args.log_dir, model_parallel=args.model_parallel,
+                                                sampler_states=sampler_states)
 
             # book keeping
             task_iteration[task] += 1
@@ -551,12 +576,15 @@ def main(args):
 
     opt, lr_scheduler = init_opt(args, model, logger)
     start_iteration = 1
+    sampler_states = None
 
     if args.resume:
         logger.info(f'Resuming training from {os.path.splitext(args.load)[0]}_optim.pth')
         # load optimizer's state_dict to cpu first to avoid GPU memory surge. Will crash with OOM if `map_location='cpu'` is not specified.
         opt_state_dict = torch.load(os.path.join(args.save, f'{os.path.splitext(args.load)[0]}_optim.pth'), map_location='cpu')
         start_iteration = opt_state_dict.pop('start_iteration')
+        # checkpoints saved before samplers had a state don't have this, and are resumed by going through the batches
+        sampler_states = opt_state_dict.pop('sampler_states', None)
         logger.info(f'Starting iteration is {start_iteration}')
         opt.load_state_dict(opt_state_dict)
 
@@ -570,7 +598,7 @@ def main(args):
           args.train_iterations, model.module.numericalizer if not args.model_parallel else model.numericalizer, val_sets=val_sets, aux_sets=aux_sets, logger=logger, writer=writer,
           log_every=args.log_every, val_every=args.val_every, save_every=args.save_every,
           rounds=len(train_sets) > 1, start_iteration=start_iteration, use_curriculum=args.use_curriculum,
-          best_decascore=best_decascore, log_prefix='training')
+          best_decascore=best_decascore, log_prefix='training', sampler_states=sampler_states)
 
     if writer is not None:
         writer.close() # otherwise the last written value may not be flushed
@@ -36,14 +36,14 @@ import shutil
 import random
 import time
 import re
-from typing import List, Optional
+from typing import List, Optional, Union
 import numpy as np
 import torch
 from transformers.models.mbart.tokenization_mbart import FAIRSEQ_LANGUAGE_CODES
 from torch.functional import Tensor
 
-from .data_utils.example import NumericalizedExamples
-from .data_utils.iterator import LengthSortedIterator
+from .data_utils.example import NumericalizedDataset
+from .data_utils.iterator import LengthSortedIterator, BucketBatchSampler
 
 logger = logging.getLogger(__name__)
 
@@ -110,26 +110,37 @@ class ConfidenceFeatures:
     Contains all necessary features that are useful for calculating confidence of a single generated output
     """
 
-    def __init__(self, drop_logits: List[Tensor], drop_probs: List[Tensor], gold_answer: Tensor, prediction: Tensor,
+    # fields that need a forward pass of the model without dropout, and fields that need MC dropout
+    NODROP_FIELDS = ('nodrop_logits', 'nodrop_probs', 'nodrop_entropies')
+    DROP_FIELDS = ('drop_logits', 'drop_probs')
+
+    def __init__(self, drop_logits: Union[List[Tensor], Tensor], drop_probs: Union[List[Tensor], Tensor], gold_answer: Tensor, prediction: Tensor,
                  nodrop_logits: Tensor, nodrop_probs: Tensor, nodrop_entropies: Tensor, context: Tensor):
         """
         Inputs:
-            droplogits: logits after MC dropout
+            droplogits: logits after MC dropout, either one tensor per MC sample or already stacked into shape (mc_dropout_num, output_length)
             gold_answer: includes BOS and EOS tokens, but no PAD tokens
             prediction: includes BOS and EOS tokens, but no PAD tokens
             nodrop_logits: logits for this prediction that are obtained WITHOUT activating model's dropout
+        Any of the logits, probabilities and entropies can be None if they were not computed
         """
-        if drop_logits is not None:
+        if isinstance(drop_logits, Tensor):
+            self.drop_logits = drop_logits.cpu()
+        elif drop_logits is not None:
             self.drop_logits = torch.stack(drop_logits, dim=0).cpu()
         else:
             self.drop_logits = None
-        if drop_probs is not None:
+        if isinstance(drop_probs, Tensor):
+            self.drop_probs = drop_probs.cpu()
+        elif drop_probs is not None:
             self.drop_probs = torch.stack(drop_probs, dim=0).cpu()
         else:
             self.drop_probs = None
-        self.nodrop_logits = nodrop_logits.cpu()
-        self.nodrop_probs = nodrop_probs.cpu()
-        self.nodrop_entropies = nodrop_entropies.cpu()
+        self.nodrop_logits = nodrop_logits.cpu() if nodrop_logits is not None else None
+        self.nodrop_probs = nodrop_probs.cpu() if nodrop_probs is not None else None
+        self.nodrop_entropies = nodrop_entropies.cpu() if nodrop_entropies is not None else None
+        # number of generated tokens, including EOS
+        self._prediction_length = len(prediction) - 1
 
         self.first_mistake = ConfidenceFeatures.find_first_mistake(gold_answer, prediction)
         self.context = context
@@ -141,6 +152,13 @@ class ConfidenceFeatures:
         else:
             return self.drop_logits.shape[0]
 
+    @property
+    def prediction_length(self):
+        # features saved before this was stored have all their logits
+        if not hasattr(self, '_prediction_length'):
+            return len(self.nodrop_logits)
+        return self._prediction_length
+
     @property
     def mc_dropout(self):
         return self.mc_dropout_num > 0
@@ -160,9 +178,10 @@ class ConfidenceFeatures:
         gold_answer = gold_answer[1:]
         prediction = prediction[1:]
 
-        for i in range(min(len(gold_answer), len(prediction))):
-            if gold_answer[i] != prediction[i]:
-                return i
+        common_length = min(len(gold_answer), len(prediction))
+        mistakes = (gold_answer[:common_length] != prediction[:common_length].to(gold_answer.device)).nonzero(as_tuple=False)
+        if len(mistakes) > 0:
+            return mistakes[0].item()
         if len(gold_answer) != len(prediction):
             # one is a strict prefix of the other
             return min(len(gold_answer), len(prediction))
@@ -512,21 +531,27 @@ def elapsed_time(log):
     return f'{day:02}:{hour:02}:{minutes:02}:{seconds:02}'
 
 
-def make_data_loader(dataset, numericalizer, batch_size, device=None, train=False, return_original_order=False):
-    all_features = NumericalizedExamples.from_examples(dataset, numericalizer=numericalizer)
+def make_data_loader(dataset, numericalizer, batch_size, device=None, train=False, return_original_order=False, cache_dir=None):
+    if cache_dir is not None:
+        all_features = NumericalizedDataset.from_examples_cached(dataset, numericalizer=numericalizer, cache_dir=cache_dir)
+    else:
+        all_features = NumericalizedDataset.from_examples(dataset, numericalizer=numericalizer)
 
-    context_lengths = [ex.context.length for ex in all_features]
-    answer_lengths = [ex.answer.length for ex in all_features]
+    context_lengths = all_features.context.lengths
+    answer_lengths = all_features.answer.lengths
 
     logger.info(f'context lengths (min, mean, max): {np.min(context_lengths)}, {int(np.mean(context_lengths))}, {np.max(context_lengths)}')
     logger.info(f'answer lengths (min, mean, max): {np.min(answer_lengths)}, {int(np.mean(answer_lengths))}, {np.max(answer_lengths)}')
     
-    sampler = LengthSortedIterator(all_features, batch_size=batch_size, sort=True, shuffle_and_repeat=train,
-                                   sort_key_fn=dataset.sort_key_fn, batch_size_fn=dataset.batch_size_fn, groups=dataset.groups)
-    # get the sorted data_source
+    if train and (dataset.groups is None or dataset.groups == 1):
+        sampler = BucketBatchSampler(all_features, batch_size=batch_size, sort_key_fn=dataset.sort_key_fn, batch_size_fn=dataset.batch_size_fn)
+    else:
+        sampler = LengthSortedIterator(all_features, batch_size=batch_size, sort=True, shuffle_and_repeat=train,
+                                       sort_key_fn=dataset.sort_key_fn, batch_size_fn=dataset.batch_size_fn, groups=dataset.groups)
+    # get the sorted data_source; batches are padded directly from its columns, so the DataLoader only passes indices around
     all_f = sampler.data_source
-    data_loader = torch.utils.data.DataLoader(all_f, batch_sampler=sampler,
-                                              collate_fn=lambda batches: NumericalizedExamples.collate_batches(batches, numericalizer, device),
+    data_loader = torch.utils.data.DataLoader(range(len(all_f)), batch_sampler=sampler,
+                                              collate_fn=lambda indices: all_f.collate(indices, numericalizer, device),
                                               num_workers=0)
     
     if return_original_order:
@@ -552,7 +577,8 @@ def load_config_json(args):
                     'max_generative_vocab', 'lower', 'trainable_decoder_embeddings',
                     'override_context', 'override_question',
                     'almond_lang_as_question', 'almond_has_multiple_programs', 'almond_detokenize_sentence',
-                    'preprocess_special_tokens', 'dropper_ratio', 'dropper_min_count']
+                    'preprocess_special_tokens', 'dropper_ratio', 'dropper_min_count', 'decoder_shortlist',
+                    'draft_ngram_table']
 
         # train and predict scripts have these arguments in common. We use the values from train only if they are not provided in predict
         overwrite = ['val_batch_size', 'num_beams', 'num_beam_groups', 'diversity_penalty',
@@ -566,7 +592,7 @@ def load_config_json(args):
             if r in config:
                 setattr(args, r, config[r])
             # These are for backward compatibility with models that were trained before we added these arguments
-            elif r in ('preprocess_special_tokens'):
+            elif r in ('preprocess_special_tokens', 'decoder_shortlist', 'draft_ngram_table'):
                 setattr(args, r, False)
             elif r == 'num_beam_groups':
                 setattr(args, r, [1])
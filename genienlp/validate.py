@@ -31,6 +31,7 @@
 import sys
 import torch
 from collections import OrderedDict
+from contextlib import nullcontext
 
 from .util import GenerationOutput
 from .data_utils.progbar import progress_bar
@@ -42,11 +43,13 @@ def generate_with_model(model, data_iterator, numericalizer, task, args,
                         output_confidence_features=False,
                         original_order=None,
                         confidence_estimator=None,
-                        disable_progbar=True) -> GenerationOutput:
+                        disable_progbar=True,
+                        timer=None) -> GenerationOutput:
     """
     Inputs:
         original_order: List of indices. If provided, we will sort the results according to this order
         confidence_estimator: if provided, will use it to calculate and output confidence scores
+        timer: if provided, an object whose `time(stage)` method returns a context manager that times each stage of generation
     Outputs: predictions if `output_predictions_only` == True, (loss, predictions, answers, contexts) otherwise
         loss
         predictions: a List of Lists of strings
@@ -54,6 +57,14 @@ def generate_with_model(model, data_iterator, numericalizer, task, args,
         contexts
     """
     output_confidence_scores = confidence_estimator is not None
+    # when features are only used for the confidence scores, compute just what the estimator reads
+    required_features = None
+    if output_confidence_scores and not output_confidence_features:
+        required_features = confidence_estimator.required_features()
+    if timer is None:
+        time_stage = lambda stage: nullcontext()
+    else:
+        time_stage = timer.time
     if isinstance(model, torch.nn.DataParallel):
         # get rid of the DataParallel wrapper
         model = model.module
@@ -76,26 +87,38 @@ def generate_with_model(model, data_iterator, numericalizer, task, args,
             batch_context = numericalizer.reverse(batch.context.value.data)
             contexts += batch_context
 
+        encoder_output = None
+        if len(args.temperature) > 1:
+            # the encoder does not depend on the decoding hyperparameters, so we run it once for all of them
+            with time_stage('encode'):
+                encoder_output = model.encode(batch)
+
         for hyperparameter_idx in range(len(args.temperature)):
-            raw_partial_batch_prediction = model.generate(batch,
-                                                max_output_length=args.max_output_length,
-                                                num_outputs=args.num_outputs[hyperparameter_idx],
-                                                temperature=args.temperature[hyperparameter_idx] if args.temperature[hyperparameter_idx] > 0 else 1.0,
-                                                repetition_penalty=args.repetition_penalty[hyperparameter_idx],
-                                                top_k=args.top_k[hyperparameter_idx],
-                                                top_p=args.top_p[hyperparameter_idx],
-                                                num_beams=args.num_beams[hyperparameter_idx],
-                                                num_beam_groups=args.num_beam_groups[hyperparameter_idx],
-                                                diversity_penalty=args.diversity_penalty[hyperparameter_idx],
-                                                no_repeat_ngram_size=args.no_repeat_ngram_size[hyperparameter_idx],
-                                                do_sample=args.temperature[hyperparameter_idx]!=0,  # if temperature==0, we do not sample
-                                                )
+            with time_stage('generate'):
+                raw_partial_batch_prediction = model.generate(batch,
+                                                    max_output_length=args.max_output_length,
+                                                    num_outputs=args.num_outputs[hyperparameter_idx],
+                                                    temperature=args.temperature[hyperparameter_idx] if args.temperature[hyperparameter_idx] > 0 else 1.0,
+                                                    repetition_penalty=args.repetition_penalty[hyperparameter_idx],
+                                                    top_k=args.top_k[hyperparameter_idx],
+                                                    top_p=args.top_p[hyperparameter_idx],
+                                                    num_beams=args.num_beams[hyperparameter_idx],
+                                                    num_beam_groups=args.num_beam_groups[hyperparameter_idx],
+                                                    diversity_penalty=args.diversity_penalty[hyperparameter_idx],
+                                                    no_repeat_ngram_size=args.no_repeat_ngram_size[hyperparameter_idx],
+                                                    do_sample=args.temperature[hyperparameter_idx]!=0,  # if temperature==0, we do not sample
+                                                    encoder_output=encoder_output
+                                                    )
             if output_confidence_features or output_confidence_scores:
-                partial_batch_confidence_features =  model.confidence_features(batch=batch, predictions=raw_partial_batch_prediction, mc_dropout=args.mc_dropout, mc_dropout_num=args.mc_dropout_num)
-            partial_batch_prediction = numericalizer.reverse(raw_partial_batch_prediction)
+                with time_stage('confidence_features'):
+                    partial_batch_confidence_features =  model.confidence_features(batch=batch, predictions=raw_partial_batch_prediction, mc_dropout=args.mc_dropout, mc_dropout_num=args.mc_dropout_num,
+                                                                                   features=required_features)
+            with time_stage('reverse'):
+                partial_batch_prediction = numericalizer.reverse(raw_partial_batch_prediction)
             # post-process predictions
-            for i in range(len(partial_batch_prediction)):
-                partial_batch_prediction[i] = task.postprocess_prediction(example_ids[(i//args.num_outputs[hyperparameter_idx]) % batch_size], partial_batch_prediction[i])
+            with time_stage('postprocess'):
+                for i in range(len(partial_batch_prediction)):
+                    partial_batch_prediction[i] = task.postprocess_prediction(example_ids[(i//args.num_outputs[hyperparameter_idx]) % batch_size], partial_batch_prediction[i])
             # put them into the right array
             for i in range(len(partial_batch_prediction)):
                 batch_prediction[(i//args.num_outputs[hyperparameter_idx]) % batch_size].append(partial_batch_prediction[i])
@@ -107,7 +130,11 @@ def generate_with_model(model, data_iterator, numericalizer, task, args,
     
     if original_order is not None:
         # sort back to the original order
-        original_order, example_ids, predictions, answers, contexts, confidence_features = [list(a) for a in tuple(zip(*sorted(list(zip(original_order, example_ids, predictions, answers, contexts, confidence_features)))))]
+        # answers and contexts are empty if output_predictions_only is True, so they are sorted only if they are there
+        sorted_indices = sorted(range(len(original_order)), key=lambda i: original_order[i])
+        example_ids, predictions, confidence_features = [[a[i] for i in sorted_indices] for a in (example_ids, predictions, confidence_features)]
+        if not output_predictions_only:
+            answers, contexts = [[a[i] for i in sorted_indices] for a in (answers, contexts)]
     
     # TODO calculate and return loss
     loss = None
@@ -120,7 +147,8 @@ def generate_with_model(model, data_iterator, numericalizer, task, args,
     if output_confidence_features:
         output.confidence_features = confidence_features
     if output_confidence_scores:
-        confidence_scores = confidence_estimator.estimate(confidence_features)
+        with time_stage('calibrate'):
+            confidence_scores = confidence_estimator.estimate(confidence_features)
         output.confidence_scores = confidence_scores
 
     return output
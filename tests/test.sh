@@ -32,6 +32,7 @@ for hparams in \
       "--model TransformerSeq2Seq --pretrained_model sshleifer/tiny-mbart" \
       "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random --preprocess_special_tokens" \
       "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random --almond_detokenize_sentence" \
+      "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random --decoder_shortlist --draft_ngram_table" \
       "--model TransformerLSTM --pretrained_model bert-base-cased --trainable_decoder_embeddings=50 --num_beams 4 --num_beam_groups 4 --num_outputs 4 --diversity_penalty 1.0" \
       "--model TransformerLSTM --pretrained_model bert-base-multilingual-cased --trainable_decoder_embeddings=50" \
       "--model TransformerLSTM --pretrained_model xlm-roberta-base --trainable_decoder_embeddings=50" \
@@ -50,12 +51,182 @@ do
         exit
     fi
 
+    # check that the output shortlist was built and saved with the model
+    if [[ "$hparams" == *--decoder_shortlist* ]] && test ! -s $workdir/model_$i/output-shortlist.txt ; then
+        echo "Output shortlist not found!"
+        exit 1
+    fi
+
+    # speculative greedy decoding must produce the same predictions as greedy decoding
+    if [[ "$hparams" == *--draft_ngram_table* ]] ; then
+        if test ! -s $workdir/model_$i/answer-ngrams.json ; then
+            echo "Answer n-gram table not found!"
+            exit 1
+        fi
+        pipenv run python3 -m genienlp predict --tasks almond --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results_draft/ --data $SRCDIR/dataset/ --embeddings $embedding_dir --skip_cache --num_draft_tokens 4
+        diff -u $workdir/model_$i/eval_results/test/almond.tsv $workdir/model_$i/eval_results_draft/test/almond.tsv
+    fi
+
+    # with several decoding configurations the encoder runs once per batch, and greedy and beam search outputs
+    # must be the same as with each configuration alone
+    if [[ "$hparams" == *bart-tiny-random || "$hparams" == *multilingual-cased\ --trainable_decoder_embeddings=50 ]] ; then
+        pipenv run python3 -m genienlp predict --tasks almond --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results_multi/ --data $SRCDIR/dataset/ --embeddings $embedding_dir --skip_cache --temperature 0 0.5 0 --num_beams 1 1 4
+        pipenv run python3 -m genienlp predict --tasks almond --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results_beam/ --data $SRCDIR/dataset/ --embeddings $embedding_dir --skip_cache --num_beams 4
+        cut -f 1,2 $workdir/model_$i/eval_results_multi/test/almond.tsv | diff -u $workdir/model_$i/eval_results/test/almond.tsv -
+        cut -f 1,4 $workdir/model_$i/eval_results_multi/test/almond.tsv | diff -u $workdir/model_$i/eval_results_beam/test/almond.tsv -
+    fi
+
+    # greedy decoding from the candidate tokens of each step gives the same outputs as decoding from the whole distribution
+    if [[ "$hparams" == *TransformerLSTM* ]] ; then
+        pipenv run python3 - $workdir/model_$i $SRCDIR/dataset/almond/train.tsv $embedding_dir <<'EOF'
+import argparse, sys
+import torch
+from genienlp import server
+from genienlp.data_utils.example import Example, NumericalizedExamples
+
+model_dir, data_file, embedding_dir = sys.argv[1:]
+parser = argparse.ArgumentParser()
+server.parse_argv(parser)
+args = parser.parse_args(['--path', model_dir, '--embeddings', embedding_dir])
+model = server.load_model(args, model_dir, None, torch.device('cpu'), 'default').model
+with open(data_file) as fp:
+    examples = [Example.from_raw(parts[0], parts[1], 'translate to thingtalk', parts[2]) for parts in (line.rstrip('\n').split('\t') for line in fp)]
+examples = NumericalizedExamples.from_examples(examples, model.numericalizer)
+for start in range(0, len(examples), 4):
+    batch = NumericalizedExamples.collate_batches(examples[start:start + 4], model.numericalizer, device='cpu')
+    candidate = model._candidate_greedy_generate(batch, max_output_length=40)
+    dense = model._greedy_or_sample_generate(batch, max_output_length=40, temperature=1.0, repetition_penalty=1.0, top_k=0, top_p=1.0,
+                                             no_repeat_ngram_size=0, do_sample=False)
+    assert model.numericalizer.reverse(candidate) == model.numericalizer.reverse(dense), start
+EOF
+    fi
+
     # test exporting
     pipenv run python3 -m genienlp export --path $workdir/model_$i --output $workdir/model_$i_exported
 
     if [ $i == 0 ] ; then
       echo "Testing the server mode"
       echo '{"id": "dummy_example_1", "context": "show me .", "question": "translate to thingtalk", "answer": "now => () => notify"}' | pipenv run python3 -m genienlp server --path $workdir/model_$i --stdin
+
+      # lines that are read ahead are decoded together, and answered in input order
+      printf '%s\n' \
+        '{"id": "line_1", "context": "show me .", "question": "translate to thingtalk"}' \
+        '{"id": "line_2", "context": "show me the weather .", "question": "translate to thingtalk"}' \
+        '{"id": "line_3", "context": "show me restaurants .", "question": "translate to thingtalk"}' \
+        | pipenv run python3 -m genienlp server --path $workdir/model_$i --stdin > $workdir/stdin_responses.jsonl
+      pipenv run python3 -c 'import json, sys; ids = [json.loads(line)["id"] for line in open(sys.argv[1])]; assert ids == ["line_1", "line_2", "line_3"], ids' $workdir/stdin_responses.jsonl
+
+      echo "Testing the server mode over TCP"
+      (pipenv run python3 -m genienlp server --path $workdir/model_$i --port 8401 --max_batch_wait 1000 --cache_size 10)&
+      SERVER_PID=$!
+      for attempt in $(seq 60) ; do
+        if (echo > /dev/tcp/localhost/8401) 2>/dev/null ; then
+          break
+        fi
+        sleep 1
+      done
+
+      # requests that arrive on different connections within --max_batch_wait are decoded in the same batch
+      exec 3<>/dev/tcp/localhost/8401
+      exec 4<>/dev/tcp/localhost/8401
+      echo '{"id": "conn_1", "context": "show me .", "question": "translate to thingtalk"}' >&3
+      echo '{"id": "conn_2", "context": "show me the weather .", "question": "translate to thingtalk"}' >&4
+      read -r -t 60 response_1 <&3
+      read -r -t 60 response_2 <&4
+      # the same examples again are answered from the prediction cache
+      echo '{"id": "cached", "instances": [{"context": "show me .", "question": "translate to thingtalk"}, {"context": "show me the weather .", "question": "translate to thingtalk"}]}' >&3
+      read -r -t 60 cached_response <&3
+      # a streamed request gets the partial answer after each token, then the full answer
+      echo '{"id": "stream", "context": "show me restaurants .", "question": "translate to thingtalk", "stream": true}' >&3
+      num_partial=0
+      read -r -t 60 stream_response <&3
+      while [[ "$stream_response" == *'"partial"'* ]] ; do
+        num_partial=$((num_partial+1))
+        read -r -t 60 stream_response <&3
+      done
+      echo '{"id": "stats", "type": "stats"}' >&3
+      read -r -t 60 stats <&3
+      exec 3>&- 4>&-
+      kill $SERVER_PID
+
+      echo "$response_1" "$response_2" "$cached_response" "$stream_response" "$stats"
+      if [[ "$response_1" != *'"id": "conn_1", "answer"'* || "$response_2" != *'"id": "conn_2", "answer"'* ]] ; then
+          echo "Unexpected server response!"
+          exit 1
+      fi
+      if [[ $num_partial == 0 || "$stream_response" != *'"id": "stream", "answer"'* ]] ; then
+          echo "Unexpected server response!"
+          exit 1
+      fi
+      # at least one batch had more than one example
+      echo "$stats" | pipenv run python3 -c 'import json, sys; batches = json.load(sys.stdin)["stats"]["genienlp_batch_size_examples"]["all"]; assert batches["buckets"]["1"] < batches["count"], batches'
+      # cached answers are the same as the decoded ones
+      printf '%s\n' "$response_1" "$response_2" "$cached_response" | pipenv run python3 -c 'import json, sys; first, second, cached = map(json.loads, sys.stdin); assert [first["answer"], second["answer"]] == [instance["answer"] for instance in cached["instances"]], cached'
+      echo "$stats" | pipenv run python3 -c 'import json, sys; cache = json.load(sys.stdin)["stats"]["cache"]; assert cache["hits"] == 2 and cache["misses"] == 3, cache'
+
+      echo "Testing the server mode with multiple workers"
+      # workers only serve over TCP
+      if echo '{"id": "dummy_example_1", "context": "show me .", "question": "translate to thingtalk"}' | pipenv run python3 -m genienlp server --path $workdir/model_$i --stdin --workers 2 ; then
+          echo "--workers was accepted with --stdin!"
+          exit 1
+      fi
+      (pipenv run python3 -m genienlp server --path $workdir/model_$i --port 8402 --workers 2)&
+      SERVER_PID=$!
+      for attempt in $(seq 60) ; do
+        if (echo > /dev/tcp/localhost/8402) 2>/dev/null ; then
+          break
+        fi
+        sleep 1
+      done
+      # each connection is accepted by one of the workers, which all listen on the same port
+      for conn in $(seq 6) ; do
+        exec 3<>/dev/tcp/localhost/8402
+        echo '{"id": "worker_'$conn'", "context": "show me .", "question": "translate to thingtalk"}' >&3
+        read -r -t 60 response <&3
+        exec 3>&-
+        if [[ "$response" != *'"id": "worker_'$conn'", "answer"'* ]] ; then
+            kill $SERVER_PID
+            echo "Unexpected server response!"
+            exit 1
+        fi
+      done
+      kill $SERVER_PID
+
+      echo "Testing the server mode with multiple models"
+      # models are named after their directory
+      cp -r $workdir/model_$i $workdir/other_model
+      # the memory limit is smaller than any model, so loading a model unloads the other one
+      (pipenv run python3 -m genienlp server --path $workdir/model_$i $workdir/other_model --port 8403 --max_model_memory 0.000001)&
+      SERVER_PID=$!
+      for attempt in $(seq 60) ; do
+        if (echo > /dev/tcp/localhost/8403) 2>/dev/null ; then
+          break
+        fi
+        sleep 1
+      done
+      exec 3<>/dev/tcp/localhost/8403
+      for model in model_$i other_model model_$i ; do
+        echo '{"id": "'$model'", "model": "'$model'", "context": "show me .", "question": "translate to thingtalk"}' >&3
+        read -r -t 60 response <&3
+        echo '{"id": "stats", "type": "stats"}' >&3
+        read -r -t 60 stats <&3
+        echo "$response" "$stats"
+        if [[ "$response" != *'"id": "'$model'", "answer"'* ]] ; then
+            echo "Unexpected server response!"
+            exit 1
+        fi
+        # the request was routed to its model, which is the only one left in memory
+        echo "$stats" | pipenv run python3 -c 'import json, sys; loaded = json.load(sys.stdin)["stats"]["loaded_models"]; assert loaded == [sys.argv[1]], loaded' $model
+      done
+      echo '{"id": "unknown", "model": "no_such_model", "context": "show me .", "question": "translate to thingtalk"}' >&3
+      read -r -t 60 response <&3
+      exec 3>&-
+      kill $SERVER_PID
+      if [[ "$response" != *'"id": "unknown", "error"'* ]] ; then
+          echo "Unexpected server response!"
+          exit 1
+      fi
+      rm -rf $workdir/other_model
     fi
 
     rm -rf $workdir/model_$i $workdir/model_$i_exported
@@ -63,6 +234,204 @@ do
     i=$((i+1))
 done
 
+# the LSTM decoder gives the same outputs and gradients as decoding one step at a time and concatenating the steps
+pipenv run python3 - <<'EOF'
+import torch
+from genienlp.models.mqan_decoder import LSTMDecoder
+
+def reference_forward(decoder, input, context, hidden, num_beams):
+    context_output = decoder.make_init_output(input)
+    context_outputs, vocab_pointer_switch_inputs, context_attentions = [], [], []
+    for decoder_input in input.split(1, dim=1):
+        rnn_input = torch.cat([decoder_input, context_output], 2).squeeze(1)
+        dec_state, hidden = decoder.rnn(rnn_input, hidden)
+        dec_state = dec_state.unsqueeze(1)
+        context_output, context_attention = decoder._attend(dec_state, context, num_beams)
+        vocab_pointer_switch_inputs.append(torch.cat([dec_state, context_output, decoder_input], -1))
+        context_outputs.append(context_output)
+        context_attentions.append(context_attention)
+    return [torch.cat(x, dim=1) for x in (context_outputs, vocab_pointer_switch_inputs, context_attentions)] + [hidden]
+
+def outputs_and_gradients(forward, decoder, input, context, context_mask, hidden, num_beams):
+    input, context = input.clone().requires_grad_(), context.clone().requires_grad_()
+    decoder.zero_grad()
+    decoder.applyMasks(context_mask)
+    outputs = forward(input, context, hidden, num_beams)
+    outputs = outputs[:3] + list(outputs[3])
+    loss = sum((output * torch.rand(output.shape, generator=torch.Generator().manual_seed(i), dtype=output.dtype)).sum() for i, output in enumerate(outputs))
+    loss.backward()
+    return [output.detach() for output in outputs] + [input.grad, context.grad] + [p.grad for p in decoder.parameters() if p.grad is not None]
+
+torch.manual_seed(0)
+for batch_size, decoder_time, num_layers, num_beams in ((3, 7, 1, 1), (4, 5, 2, 1), (6, 1, 2, 3)):
+    decoder = LSTMDecoder(6, 8, num_layers=num_layers).double()
+    input = torch.randn(batch_size, decoder_time, 6, dtype=torch.double)
+    context = torch.randn(batch_size // num_beams, 5, 8, dtype=torch.double)
+    context_mask = torch.zeros(batch_size // num_beams, 5, dtype=torch.bool)
+    context_mask[0, -2:] = True
+    hidden = tuple(torch.randn(num_layers, batch_size, 8, dtype=torch.double) for _ in range(2))
+    actual = outputs_and_gradients(lambda *args: decoder(args[0], args[1], hidden=args[2], num_beams=args[3]),
+                                   decoder, input, context, context_mask, hidden, num_beams)
+    expected = outputs_and_gradients(lambda *args: reference_forward(decoder, *args), decoder, input, context, context_mask, hidden, num_beams)
+    assert len(actual) == len(expected)
+    for a, e in zip(actual, expected):
+        assert torch.allclose(a, e), (batch_size, decoder_time, num_layers, num_beams)
+EOF
+
+# test the data pipeline
+
+# length-sorted batches hold as many examples as fit in the batch size, and cover every example that fits exactly once
+pipenv run python3 - <<'EOF'
+import random
+from genienlp.data_utils.iterator import LengthSortedIterator
+
+random.seed(0)
+for batch_size in (1, 7, 50, 100):
+    for keep_large_examples in (False, True):
+        sizes = [random.randint(1, 60) for _ in range(500)]
+        iterator = LengthSortedIterator(sizes, batch_size=batch_size, sort=True, shuffle_and_repeat=False,
+                                        sort_key_fn=lambda x: x, batch_size_fn=lambda x: x, keep_large_examples=keep_large_examples)
+        sorted_sizes = list(iterator.data_source)
+        assert sorted_sizes == sorted(sizes, reverse=True)
+        assert [sizes[i] for i in iterator.original_order] == sorted_sizes
+
+        batches = list(iterator)
+        assert len(batches) == len(iterator)
+        assert [i for batch in batches for i in batch] == [i for i, size in enumerate(sorted_sizes) if size <= batch_size or keep_large_examples]
+        for batch in batches:
+            # the first example of a batch is the longest one, and examples larger than the batch size are alone
+            assert len(batch) * sorted_sizes[batch[0]] <= batch_size or len(batch) == 1
+            if batch[-1] + 1 < len(sorted_sizes):
+                assert (len(batch) + 1) * sorted_sizes[batch[0]] > batch_size
+
+        if not keep_large_examples and min(sizes) <= batch_size:
+            iterator = LengthSortedIterator(sizes, batch_size=batch_size, sort=True, shuffle_and_repeat=True,
+                                            sort_key_fn=lambda x: x, batch_size_fn=lambda x: x)
+            for _, batch in zip(range(200), iterator):
+                assert batch == list(range(batch[0], batch[-1] + 1))
+                assert len(batch) * sorted_sizes[batch[0]] <= batch_size
+EOF
+
+# a BucketBatchSampler restored from its state goes on with the same batches as the saved one, also across epochs
+pipenv run python3 - <<'EOF'
+import itertools, random
+from genienlp.data_utils.iterator import BucketBatchSampler
+
+random.seed(0)
+sizes = [random.randint(1, 60) for _ in range(500)]
+make_sampler = lambda seed: BucketBatchSampler(sizes, batch_size=100, sort_key_fn=lambda x: x, batch_size_fn=lambda x: x,
+                                                batches_per_bucket=5, seed=seed)
+reference = make_sampler(seed=123)
+num_batches = len(reference)
+expected = list(itertools.islice(iter(reference), 3 * num_batches))
+
+for num_before in (0, 1, num_batches - 1, num_batches, 2 * num_batches + 3):
+    sampler = make_sampler(seed=123)
+    batches = iter(sampler)
+    for _ in range(num_before):
+        next(batches)
+    # the seed is part of the state
+    restored = make_sampler(seed=None)
+    restored.load_state_dict(sampler.state_dict())
+    assert list(itertools.islice(iter(restored), 3 * num_batches - num_before)) == expected[num_before:], num_before
+EOF
+
+for hparams in \
+      "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random" \
+      "--model TransformerLSTM --pretrained_model bert-base-cased --trainable_decoder_embeddings=50" ;
+do
+
+    # train and predict twice with the same cache of numericalized data: the first run fills it, the second one loads it
+    for run in 1 2 ; do
+        pipenv run python3 -m genienlp train --train_tasks almond --train_batch_tokens 100 --val_batch_size 100 --train_iterations 6 --preserve_case --save_every 2 --log_every 2 --val_every 2 --save $workdir/model_${i}_$run --data $SRCDIR/dataset/  $hparams --exist_ok --skip_cache --embeddings $embedding_dir --no_commit --cache $workdir/cache_$i --cache_numericalized_data
+        pipenv run python3 -m genienlp predict --tasks almond --evaluate test --path $workdir/model_${i}_$run --overwrite --eval_dir $workdir/model_${i}_$run/eval_results/ --data $SRCDIR/dataset/ --embeddings $embedding_dir --skip_cache --cache $workdir/cache_$i --cache_numericalized_data
+        ls $workdir/cache_$i/numericalized > $workdir/cache_entries_${i}_$run.txt
+    done
+
+    # the second run must not add entries: loading the training set from the cache restores the decoder vocabulary,
+    # which is part of the key of the datasets numericalized after it
+    if test ! -s $workdir/cache_entries_${i}_1.txt ; then
+        echo "Numericalized data was not cached!"
+        exit 1
+    fi
+    diff -u $workdir/cache_entries_${i}_1.txt $workdir/cache_entries_${i}_2.txt
+    # and it must train the same model
+    diff -u $workdir/model_${i}_1/eval_results/test/almond.tsv $workdir/model_${i}_2/eval_results/test/almond.tsv
+
+    # numericalizing a dataset column by column gives the same tokens and batches as numericalizing its examples one by one
+    pipenv run python3 - $workdir/model_${i}_1 $SRCDIR/dataset/almond/train.tsv <<'EOF'
+import json, os, sys
+import torch
+from genienlp.data_utils.example import Example, NumericalizedDataset, NumericalizedExamples
+from genienlp.data_utils.numericalizer import TransformerNumericalizer
+
+model_dir, data_file = sys.argv[1:]
+with open(os.path.join(model_dir, 'config.json')) as fp:
+    config = json.load(fp)
+numericalizer = TransformerNumericalizer(config['pretrained_model'],
+                                         max_generative_vocab=config['max_generative_vocab'] if config['model'] == 'TransformerLSTM' else None,
+                                         cache=config['embeddings'])
+numericalizer.load(model_dir)
+with open(data_file) as fp:
+    examples = [Example.from_raw(parts[0], parts[1], 'translate to thingtalk', parts[2]) for parts in (line.rstrip('\n').split('\t') for line in fp)]
+
+dataset = NumericalizedDataset.from_examples(examples, numericalizer)
+expected = NumericalizedExamples.from_examples(examples, numericalizer)
+assert len(dataset) == len(expected)
+for i in range(len(dataset)):
+    for field in ('context', 'answer'):
+        actual, wanted = getattr(dataset[i], field), getattr(expected[i], field)
+        assert list(actual.value) == list(wanted.value) and actual.length == wanted.length and list(actual.limited) == list(wanted.limited), (i, field)
+
+indices = [len(dataset) - 1, 0, len(dataset) // 2]
+batch = dataset.collate(indices, numericalizer, device='cpu')
+expected_batch = NumericalizedExamples.collate_batches([expected[i] for i in indices], numericalizer, device='cpu')
+assert batch.example_id == expected_batch.example_id
+for field in ('context', 'answer'):
+    # without a decoder vocabulary, limited is empty
+    names = ('value', 'length', 'limited') if numericalizer.decoder_vocab is not None else ('value', 'length')
+    for name in names:
+        assert torch.equal(getattr(getattr(batch, field), name), getattr(getattr(expected_batch, field), name)), (field, name)
+EOF
+
+    # parsing a file in byte ranges in parallel gives the same examples and special tokens as parsing it line by line,
+    # with and without subsampling
+    for copy in $(seq 200) ; do
+        cat $SRCDIR/dataset/almond/train.tsv
+    done > $workdir/parallel_parsing.tsv
+    pipenv run python3 - $workdir/model_${i}_1 $workdir/parallel_parsing.tsv <<'EOF'
+import argparse, json, os, sys
+from genienlp.tasks import almond
+from genienlp.tasks.registry import get_tasks
+
+model_dir, data_file = sys.argv[1:]
+with open(os.path.join(model_dir, 'config.json')) as fp:
+    args = argparse.Namespace(**json.load(fp))
+# split the small test file in many short byte ranges
+almond.PARALLEL_READ_MIN_BYTES = 0
+almond.PARALLEL_READ_MIN_CHUNK_BYTES = 4096
+for subsample in (None, 1, 1000, 2799, 2800, 5000):
+    serial_task = list(get_tasks(['almond'], args).values())[0]
+    parallel_task = list(get_tasks(['almond'], args).values())[0]
+    serial = almond._read_lines(data_file, 0, os.path.getsize(data_file), serial_task._make_example, 'almond', subsample)
+    parallel = almond.AlmondDataset._read_examples(data_file, parallel_task._make_example, 'almond', subsample)
+    assert serial == parallel, subsample
+    assert serial_task.special_tokens == parallel_task.special_tokens, subsample
+EOF
+
+    # checkpoints save the state of the training samplers, and training resumes from it
+    pipenv run python3 -c 'import sys, torch; assert "sampler_states" in torch.load(sys.argv[1], map_location="cpu")' $workdir/model_${i}_1/iteration_4_optim.pth
+    pipenv run python3 -m genienlp train --train_tasks almond --train_batch_tokens 100 --val_batch_size 100 --train_iterations 8 --preserve_case --save_every 2 --log_every 2 --val_every 2 --save $workdir/model_${i}_1 --data $SRCDIR/dataset/  $hparams --exist_ok --skip_cache --embeddings $embedding_dir --no_commit --load iteration_4.pth --resume
+    if test ! -f $workdir/model_${i}_1/iteration_8.pth ; then
+        echo "File not found!"
+        exit 1
+    fi
+
+    rm -rf $workdir/model_${i}_1 $workdir/model_${i}_2 $workdir/cache_$i $workdir/parallel_parsing.tsv
+
+    i=$((i+1))
+done
+
 # test calibration
 for hparams in \
       "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random" ;
@@ -92,6 +461,32 @@ do
     echo "Testing the server mode after calibration"
     echo '{"id": "dummy_example_1", "context": "show me .", "question": "translate to thingtalk", "answer": "now => () => notify"}' | pipenv run python3 -m genienlp server --path $workdir/model_$i --stdin
 
+    # the server only computes the confidence features its calibrator reads, and must give the same scores as the calibrator
+    # applied to all the features saved by predict. The calibrator does not read MC dropout features, so that the scores
+    # do not depend on random dropout masks, and the server has to skip MC dropout even though the calibrator enables it
+    pipenv run python3 - $workdir/model_$i $SRCDIR/dataset/almond/test.tsv <<'EOF'
+import json, os, pickle, sys
+from genienlp.calibrate import RawConfidenceEstimator, nodrop_avg_logprob
+
+model_dir, data_file = sys.argv[1:]
+with open(os.path.join(model_dir, 'confidences.pkl'), 'rb') as fp:
+    confidences = pickle.load(fp)
+estimator = RawConfidenceEstimator(name='raw_avg_logprob', featurizers=[nodrop_avg_logprob(0)], eval_metric='aucpr',
+                                   mc_dropout=confidences[0][0].mc_dropout, mc_dropout_num=confidences[0][0].mc_dropout_num)
+assert estimator.mc_dropout
+estimator.save(os.path.join(model_dir, 'nodrop_calibrator.pkl'))
+with open(os.path.join(model_dir, 'offline_scores.json'), 'w') as fp:
+    json.dump([float(score) for score in estimator.estimate(confidences)], fp)
+
+# the same examples as predict, in the same order
+with open(data_file) as fp:
+    instances = [dict(example_id=parts[0], context=parts[1], question='translate from english to thingtalk') for parts in (line.rstrip('\n').split('\t') for line in fp)]
+with open(os.path.join(model_dir, 'calibrated_request.json'), 'w') as fp:
+    fp.write(json.dumps(dict(id='calibrated', task='almond', instances=instances)) + '\n')
+EOF
+    pipenv run python3 -m genienlp server --path $workdir/model_$i --stdin --calibrator_path $workdir/model_$i/nodrop_calibrator.pkl < $workdir/model_$i/calibrated_request.json > $workdir/model_$i/calibrated_response.json
+    pipenv run python3 -c 'import json, math, sys; offline = json.load(open(sys.argv[1])); online = [instance["score"] for instance in json.load(open(sys.argv[2]))["instances"]]; assert len(offline) == len(online) and all(math.isclose(a, b, rel_tol=1e-4, abs_tol=1e-6) for a, b in zip(offline, online)), (offline, online)' $workdir/model_$i/offline_scores.json $workdir/model_$i/calibrated_response.json
+
     rm -rf $workdir/model_$i $workdir/model_$i_exported
 
     i=$((i+1))